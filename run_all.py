@@ -1,8 +1,10 @@
 import subprocess
+import importlib
 import sys
 import time
 import os
 import logging
+import threading
 from datetime import datetime
 
 DIR_RAIZ = os.path.dirname(os.path.abspath(__file__))
@@ -36,25 +38,65 @@ def get_env_with_src():
     return env
 
 
-def run_script(script_path, description):
+def start_script(script_path, description):
+    """Abre o script num Python separado sem esperar; devolve (processo, início) ou None."""
     if not os.path.exists(script_path):
         logger.error(f"❌ ARQUIVO NÃO ENCONTRADO: {script_path}")
-        return False
+        return None
 
-    inicio = time.time()
     logger.info(f"▶️ INICIANDO: {description}")
+    return subprocess.Popen([PYTHON_EXEC, script_path], env=get_env_with_src()), time.time()
 
-    resultado = subprocess.run([PYTHON_EXEC, script_path], env=get_env_with_src())
+
+def wait_script(iniciado, description):
+    if iniciado is None:
+        return False
+
+    processo, inicio = iniciado
+    returncode = processo.wait()
 
     duracao = round(time.time() - inicio, 2)
-    if resultado.returncode == 0:
+    if returncode == 0:
         logger.info(f"✅ SUCESSO: {description} ({duracao}s)")
         return True
     else:
-        logger.error(f"❌ FALHA: {description} (Código {resultado.returncode})")
+        logger.error(f"❌ FALHA: {description} (Código {returncode})")
         return False
 
 
+def run_script(script_path, description):
+    return wait_script(start_script(script_path, description), description)
+
+
+def run_inprocess(modulo, funcao, description):
+    """
+    Executa uma etapa do pipeline no próprio interpretador, importando o módulo
+    em vez de abrir um novo Python (evita o startup + imports de pandas/geopandas).
+    """
+    inicio = time.time()
+    logger.info(f"▶️ INICIANDO: {description}")
+
+    # Mesmo ambiente do subprocess: src/ no path e matplotlib sem janela
+    if DIR_SRC not in sys.path:
+        sys.path.insert(0, DIR_SRC)
+    os.environ.setdefault("MPLBACKEND", "Agg")
+
+    try:
+        getattr(importlib.import_module(modulo), funcao)()
+    except SystemExit as e:
+        # Os scripts encerram com sys.exit(1) em erros fatais
+        if e.code not in (None, 0):
+            logger.error(f"❌ FALHA: {description} (Código {e.code})")
+            return False
+    except Exception as e:
+        logger.error(f"❌ FALHA: {description} ({e})")
+        return False
+
+    duracao = round(time.time() - inicio, 2)
+    logger.info(f"✅ SUCESSO: {description} ({duracao}s)")
+    return True
+
+
 def start_api_process(module_name, port, log_filename, description):
     logger.info(f"🚀 SUBINDO {description} na porta {port}...")
 
@@ -76,6 +118,39 @@ def start_api_process(module_name, port, log_filename, description):
     return processo
 
 
+def aguardar_primeiro_encerramento(processos):
+    """
+    Bloqueia até algum dos processos monitorados terminar e devolve o nome dele.
+    POSIX: os.waitpid(-1, 0) dorme no kernel até um filho morrer (sem polling).
+    Windows: uma thread por processo em Popen.wait() sinaliza um Event.
+    """
+    if os.name != "nt":
+        por_pid = {proc.pid: nome for nome, proc in processos.items()}
+        while True:
+            pid, status = os.waitpid(-1, 0)
+            if pid in por_pid:
+                nome = por_pid[pid]
+                # Já reaproveitado aqui: registra no Popen para poll()/terminate() saberem
+                processos[nome].returncode = os.waitstatus_to_exitcode(status)
+                return nome
+
+    encerrado = threading.Event()
+    primeiro = []
+
+    def vigiar(nome, proc):
+        proc.wait()
+        primeiro.append(nome)
+        encerrado.set()
+
+    for nome, proc in processos.items():
+        threading.Thread(target=vigiar, args=(nome, proc), daemon=True).start()
+
+    # wait() sem timeout não é interrompível por Ctrl+C no Windows
+    while not encerrado.wait(1.0):
+        pass
+    return primeiro[0]
+
+
 def verificar_banco_populado():
     from sqlalchemy import create_engine, text
     
@@ -86,17 +161,13 @@ def verificar_banco_populado():
         with engine.connect() as conn:
             tabelas = ['subestacoes', 'consumidores', 'cache_mercado']
             
-            for tabela in tabelas:
-                try:
-                    result = conn.execute(text(f"SELECT COUNT(*) FROM {tabela}"))
-                    count = result.scalar()
-                    
-                    if count == 0:
-                        return False  
-                except:
-                    return False  
-            
-            return True  
+            # Uma única ida ao banco; EXISTS para no primeiro registro (sem COUNT(*) em tabela inteira).
+            # Tabela ausente faz a consulta falhar -> banco considerado não populado, como antes.
+            sql = " AND ".join(f"EXISTS (SELECT 1 FROM {tabela})" for tabela in tabelas)
+            try:
+                return bool(conn.execute(text(f"SELECT {sql}")).scalar())
+            except:
+                return False  
             
     except Exception as e:
         logger.warning(f"⚠️ Erro ao verificar banco: {e}")
@@ -122,13 +193,21 @@ def run_pipeline():
             logger.error("🛑 Falha crítica na migração. Abortando inicialização.")
             sys.exit(1)
 
+    # O treino usa dados sintéticos e não depende do Voronoi nem da análise de mercado
+    # (que lê o Voronoi do banco): roda em paralelo com essa cadeia.
+    # Em subprocess, não em thread: as etapas in-process mexem em estado global do
+    # interpretador (sys.path, os.environ, warnings.catch_warnings)
+    logger.info("🧠 Treinando IA (Duck Curve)... Isso pode levar alguns segundos.")
+    descricao_treino = "Treinamento Modelo Random Forest"
+    treino = start_script(os.path.join(DIR_SRC, "ai", "train_model.py"), descricao_treino)
+
+    if precisa_migrar:
         logger.info("🗺️ Gerando territórios Voronoi...")
-        run_script(os.path.join(DIR_SRC, "modelos", "processar_voronoi.py"), "Gerando Territórios (Voronoi)")
+        run_inprocess("modelos.processar_voronoi", "main", "Gerando Territórios (Voronoi)")
 
-        run_script(os.path.join(DIR_SRC, "modelos", "analise_mercado.py"), "Análise de Mercado")
+        run_inprocess("modelos.analise_mercado", "analisar_mercado", "Análise de Mercado")
 
-    logger.info("🧠 Treinando IA (Duck Curve)... Isso pode levar alguns segundos.")
-    run_script(os.path.join(DIR_SRC, "ai", "train_model.py"), "Treinamento Modelo Random Forest")
+    wait_script(treino, descricao_treino)
 
 if __name__ == "__main__":
     logger.info("--- ⚡ INICIANDO SISTEMA GRIDSCOPE (HACKATHON MODE) ⚡ ---")
@@ -159,21 +238,21 @@ if __name__ == "__main__":
         logger.info("📝 Logs detalhados disponíveis na pasta /logs")
         logger.info("Press Ctrl+C para encerrar tudo.\n")
 
-        while True:
-            time.sleep(2)
-            if api_proc.poll() is not None:
-                logger.error("⚠️ CRITICAL: API Principal (8000) morreu! Verifique logs/api_service.log")
-                break
-            if api_ai_proc.poll() is not None:
-                logger.error(
-                    "⚠️ CRITICAL: API IA (8001) morreu! O Duck Curve não vai funcionar. Verifique logs/api_ai.log")
-                break
-            if api_chat_proc.poll() is not None:
-                logger.warning("⚠️ API Chat (8002) morreu! O Chat IA não vai funcionar. Verifique logs/api_chat.log")
-                break
-            if dash_proc.poll() is not None:
-                logger.warning("ℹ️ Dashboard fechado pelo usuário.")
-                break
+        encerrado = aguardar_primeiro_encerramento({
+            "api": api_proc,
+            "api_ai": api_ai_proc,
+            "api_chat": api_chat_proc,
+            "dashboard": dash_proc,
+        })
+        if encerrado == "api":
+            logger.error("⚠️ CRITICAL: API Principal (8000) morreu! Verifique logs/api_service.log")
+        elif encerrado == "api_ai":
+            logger.error(
+                "⚠️ CRITICAL: API IA (8001) morreu! O Duck Curve não vai funcionar. Verifique logs/api_ai.log")
+        elif encerrado == "api_chat":
+            logger.warning("⚠️ API Chat (8002) morreu! O Chat IA não vai funcionar. Verifique logs/api_chat.log")
+        else:
+            logger.warning("ℹ️ Dashboard fechado pelo usuário.")
 
     except KeyboardInterrupt:
         logger.info("\n🛑 Encerrando serviços...")
@@ -1,19 +1,33 @@
-import pandas as pd
 import numpy as np
 import joblib
 import uvicorn
 import traceback
 import sys
 import os
-import requests
+import httpx
 import holidays
 import calendar   
-import geopandas as gpd
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+import hashlib
+from cachetools import TTLCache
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from sqlalchemy import text
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, field_validator
 from datetime import datetime
 from shapely.geometry import Point
-from scipy.ndimage import gaussian_filter1d
+from shapely.strtree import STRtree
+
+# Numba é opcional: sem ele o kernel numérico roda como Python puro
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        def decorator(func):
+            return func
+        return decorator
 
 # Tentativa de importação do módulo de banco de dados
 try:
@@ -22,11 +36,79 @@ try:
 except ImportError:
     pass
 
-app = FastAPI(title="GridScope AI - Enterprise Full", version="7.0 Final-Fix")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Aquece o kernel da curva de pato (compilação JIT / leitura do cache em disco)
+    # para que a primeira requisição do usuário não pague esse custo
+    dummy = np.ones(24)
+    _fuse_duck(dummy, PERFIL_TIPICO, FATOR_DIURNO, GAUSS_KERNEL, dummy, dummy, 1.0, 1.0, 1.0)
+    # Arrays somente-leitura geram outra especialização no numba: aquece também o fallback
+    _fuse_duck(dummy, PERFIL_TIPICO, FATOR_DIURNO, GAUSS_KERNEL, FALLBACK_RAD, FALLBACK_TEMP, 1.0, 1.0, 1.0)
+
+    # Engine SQLAlchemy única do processo (pool reaproveitado entre requisições)
+    try:
+        app.state.db_engine = get_engine()
+    except Exception as e:
+        app.state.db_engine = None
+        print(f"⚠️ Banco indisponível no startup: {e}")
+
+    # Cliente HTTP único do processo (keep-alive com a Open-Meteo)
+    app.state.http = httpx.AsyncClient(
+        # Falha rápido (0.5 s para conectar, 2 s de leitura) e cai no clima sintético
+        timeout=httpx.Timeout(2.0, connect=0.5),
+        limits=httpx.Limits(max_keepalive_connections=32)
+    )
+    yield
+    await app.state.http.aclose()
+    if app.state.db_engine is not None:
+        app.state.db_engine.dispose()
+
+app = FastAPI(title="GridScope AI - Enterprise Full", version="7.0 Final-Fix", lifespan=lifespan,
+              default_response_class=ORJSONResponse)
 
 DIR_ATUAL = os.path.dirname(os.path.abspath(__file__))
 MODEL_PATH = os.path.join(DIR_ATUAL, "modelo_consumo.pkl")
 
+# Constantes invariantes entre requisições (calculadas uma única vez na carga do módulo)
+HORAS = np.arange(24)
+
+PERFIL_TIPICO = np.array([
+    0.3, 0.25, 0.2, 0.18, 0.2, 0.3, 0.5, 
+    0.8, 0.9, 0.85, 0.8, 0.75, 0.7,       
+    0.8, 0.9, 1.0, 0.95, 0.9, 0.85,       
+    0.7, 0.6, 0.5, 0.4, 0.35              
+], dtype=np.float64)
+
+# Janela diurna gaussiana (sigma = 4h) centrada ao meio-dia, zerada fora de 6h-19h
+FATOR_DIURNO = np.exp(-((HORAS - 12) ** 2) / (2 * 4 ** 2))
+FATOR_DIURNO[(HORAS < 6) | (HORAS > 19)] = 0
+
+TIMELINE = [f"{h:02d}:00" for h in range(24)]
+
+# Kernel gaussiano sigma = 1h truncado em +-2h (5 taps), normalizado para soma 1
+GAUSS_KERNEL = np.exp(-0.5 * np.arange(-2, 3) ** 2)
+GAUSS_KERNEL /= GAUSS_KERNEL.sum()
+
+# Clima sintético de fallback (indisponibilidade da Open-Meteo), somente leitura
+FALLBACK_RAD = 1000 * np.exp(-((HORAS - 12) ** 2) / (2 * 3.5 ** 2))
+FALLBACK_RAD[(HORAS < 6) | (HORAS > 18)] = 0
+FALLBACK_RAD.setflags(write=False)
+FALLBACK_TEMP = 25 + 5 * np.sin((HORAS - 14) * np.pi / 12)
+FALLBACK_TEMP.setflags(write=False)
+
+# Feriados nacionais pré-calculados: consulta vira um único probe em frozenset,
+# sem instanciar holidays.Brazil() (e seu cálculo preguiçoso por ano) a cada requisição
+BR_HOLIDAYS = frozenset(holidays.Brazil(years=range(2020, 2036)).keys())
+
+# Cache do clima horário: para um mesmo (lat, lon, data) a resposta da Open-Meteo
+# não muda ao longo da hora. Coordenadas arredondadas em 2 casas (~1 km) para
+# que pontos vizinhos compartilhem a mesma entrada.
+_clima_cache = TTLCache(maxsize=1024, ttl=3600)
+
+# Cache de respostas completas do /predict/duck-curve: o dashboard repete as
+# mesmas entradas ao mexer nos sliders. TTL curto para acompanhar clima/banco.
+_resposta_cache = TTLCache(maxsize=2048, ttl=300)
+
 # Carregar modelo ML se existir
 model_rf = None
 if os.path.exists(MODEL_PATH):
@@ -45,26 +127,54 @@ try:
 except Exception as e:
     print(f"⚠️ Falha ao carregar subestações do banco: {e}")
 
+# Subestações reprojetadas + índice espacial (STRtree), montados uma única vez
+gdf_subs_4326 = None
+subs_tree = None
+if gdf_subs is not None and not gdf_subs.empty:
+    try:
+        gdf_subs_4326 = gdf_subs.to_crs("EPSG:4326")
+        subs_tree = STRtree(gdf_subs_4326.geometry.values)
+    except Exception as e:
+        print(f"⚠️ Falha ao indexar subestações: {e}")
+
 class DuckCurveRequest(BaseModel):
+    # Imutável e sem campos extras; o DNA chega já validado como float pelo pydantic-core
+    model_config = ConfigDict(frozen=True, extra='forbid')
+
     data_alvo: str
     potencia_gd_kw: float
     consumo_mes_alvo_mwh: float 
     lat: float
     lon: float
-    dna_perfil: dict | None = None 
+    dna_perfil: dict[str, float] | None = None 
+
+    @field_validator('lat', 'lon')
+    @classmethod
+    def _quantizar_coordenada(cls, v):
+        # 4 casas (~10 m): micro-movimentos do mapa caem nas mesmas entradas de cache
+        return round(v, 4)
 
 def normalizar_id(valor):
-    if pd.isna(valor): return ""
+    # None ou NaN (float/np.float64) viram ID vazio
+    if valor is None or (isinstance(valor, float) and valor != valor): return ""
     s = str(valor).strip().replace('.0', '')
     return s
 
+def _obter_engine():
+    """Retorna a engine do processo, criando-a sob demanda se o startup falhou."""
+    engine = getattr(app.state, "db_engine", None)
+    if engine is None:
+        engine = get_engine()
+        app.state.db_engine = engine
+    return engine
+
 def buscar_dados_reais_interno(nome_subestacao, mes_alvo):
     """Busca o consumo real no banco de dados para calibrar a simulação."""
     if not nome_subestacao or nome_subestacao == "Desconhecida":
         return None
         
     try:
-        from database import carregar_subestacoes, get_engine
+        from database import carregar_subestacoes
         
         # Se o gdf global não estiver carregado, tenta carregar local
         local_gdf = gdf_subs if gdf_subs is not None else carregar_subestacoes()
@@ -78,56 +188,62 @@ def buscar_dados_reais_interno(nome_subestacao, mes_alvo):
 
         id_alvo = normalizar_id(local_gdf[filtro].iloc[0]['COD_ID'])
         
-        engine = get_engine()
         col_mes = f"ENE_{int(mes_alvo):02d}"
         
-        # Query segura
-        sql = f"""
+        # Query parametrizada (a coluna vem de um inteiro, o ID vai como bind)
+        sql = text(f"""
             SELECT SUM(c."{col_mes}") as total_kwh
             FROM consumidores c
             JOIN transformadores t ON c."UNI_TR_MT" = t."COD_ID"
-            WHERE t."SUB" = '{id_alvo}'
-        """
+            WHERE t."SUB" = :sub
+        """)
         
-        result = pd.read_sql(sql, engine)
-        engine.dispose()
+        # Uma única linha escalar: cursor direto, sem montar DataFrame
+        with _obter_engine().connect() as conn:
+            row = conn.execute(sql, {"sub": id_alvo}).fetchone()
         
-        if not result.empty and pd.notna(result['total_kwh'].iloc[0]):
-            # IMPORTANTE: Converter para float nativo do Python para evitar erro de Série
-            val = float(result['total_kwh'].iloc[0])
-            return val
+        if row is not None and row[0] is not None:
+            return float(row[0])
         
         return None
-
     except Exception as e:
         print(f"❌ Erro ETL Banco: {e}")
         return None
 
 def resolver_subestacao(lat, lon):
     if gdf_subs is None or gdf_subs.empty: return "Desconhecida"
+    if subs_tree is None: return "Não Mapeada"
+    # 4 casas decimais (~10 m): cliques vizinhos compartilham a entrada do cache
+    return _resolver_subestacao_ponto(round(lat, 4), round(lon, 4))
+
+@lru_cache(maxsize=8192)
+def _resolver_subestacao_ponto(lat, lon):
     try:
-        ponto = gpd.GeoDataFrame(geometry=[Point(lon, lat)], crs="EPSG:4326")
-        gdf_alvo = gdf_subs.to_crs("EPSG:4326")
-        
-        join = gpd.sjoin(ponto, gdf_alvo, how="left", predicate="within")
-        if not join.empty:
+        indices = subs_tree.query(Point(lon, lat), predicate="within")
+        if len(indices) > 0:
             # Retorna o primeiro match encontrado
-            return str(join.iloc[0].get('NOME', join.iloc[0].get('NOM', 'Subestação')))
-    except: 
+            row = gdf_subs_4326.iloc[int(indices.min())]
+            return str(row.get('NOME', row.get('NOM', 'Subestação')))
+    except Exception:
         pass
     return "Não Mapeada"
 
-def obter_clima(lat, lon, data_str):
+async def obter_clima(client, lat, lon, data_str):
     """Obtém dados da API Open-Meteo ou gera dados sintéticos em caso de falha."""
+    chave = (round(lat, 2), round(lon, 2), data_str)
+    cached = _clima_cache.get(chave)
+    if cached is not None:
+        return cached
+
     try:
         url = "https://api.open-meteo.com/v1/forecast"
         params = {
-            "latitude": lat, "longitude": lon, 
+            "latitude": chave[0], "longitude": chave[1], 
             "start_date": data_str, "end_date": data_str, 
             "hourly": ["shortwave_radiation", "temperature_2m"], 
             "timezone": "America/Sao_Paulo"
         }
-        r = requests.get(url, params=params, timeout=3)
+        r = await client.get(url, params=params)
         if r.status_code == 200:
             d = r.json()
             r_api = np.array(d["hourly"]["shortwave_radiation"], dtype=float)
@@ -135,17 +251,16 @@ def obter_clima(lat, lon, data_str):
             
             # Garantir 24 horas
             if len(r_api) >= 24:
-                return r_api[:24], t_api[:24]
-    except:
+                resultado = (r_api[:24], t_api[:24])
+                # Só respostas reais são cacheadas; o fallback sintético não
+                _clima_cache[chave] = resultado
+                return resultado
+    # Sem except nu: CancelledError (BaseException) precisa subir para a requisição cancelada terminar
+    except (httpx.HTTPError, ValueError, KeyError, TypeError):
         pass
     
-    # Fallback sintético
-    horas = np.arange(24)
-    rad = 1000 * np.exp(-((horas - 12) ** 2) / (2 * 3.5 ** 2))
-    rad[(horas < 6) | (horas > 18)] = 0
-    temp = 25 + 5 * np.sin((horas - 14) * np.pi / 12)
-    
-    return rad, temp
+    # Fallback sintético (pré-calculado; o kernel apenas lê os arrays)
+    return FALLBACK_RAD, FALLBACK_TEMP
 
 def prever_curva_ml(data_alvo, dna):
     """Gera o shape da curva de consumo usando ML ou heurística."""
@@ -153,22 +268,23 @@ def prever_curva_ml(data_alvo, dna):
     
     if model_rf:
         try:
-            br_holidays = holidays.Brazil()
-            eh_feriado = int(data_alvo.date() in br_holidays)
+            eh_feriado = int(data_alvo.date() in BR_HOLIDAYS)
             eh_fds = int(data_alvo.weekday() >= 5)
             
-            features = []
-            for h in range(24):
-                features.append({
-                    "hora": h, "mes": data_alvo.month, "dia_semana": data_alvo.weekday(),
-                    "eh_feriado": eh_feriado, "eh_fim_semana": eh_fds,
-                    "pct_residencial": float(dna.get('residencial',0)),
-                    "pct_comercial": float(dna.get('comercial',0)),
-                    "pct_industrial": float(dna.get('industrial',0)),
-                    "pct_rural": float(dna.get('rural',0))
-                })
+            # Matriz de features (24 x 9) na mesma ordem de colunas do treino:
+            # hora, mes, dia_semana, eh_feriado, eh_fim_semana, pct_res, pct_com, pct_ind, pct_rur
+            features = np.empty((24, 9), dtype=np.float64)
+            features[:, 0] = HORAS
+            features[:, 1] = data_alvo.month
+            features[:, 2] = data_alvo.weekday()
+            features[:, 3] = eh_feriado
+            features[:, 4] = eh_fds
+            features[:, 5:9] = (
+                dna.get('residencial', 0.0), dna.get('comercial', 0.0),
+                dna.get('industrial', 0.0), dna.get('rural', 0.0)
+            )
             
-            predicao = model_rf.predict(pd.DataFrame(features))
+            predicao = model_rf.predict(features)
             return np.array(predicao, dtype=float)
         except: 
             pass
@@ -177,8 +293,76 @@ def prever_curva_ml(data_alvo, dna):
     t = np.linspace(0, 24, 24)
     return np.maximum(10 + 5 * np.sin((t - 10) * np.pi / 12), 0.1)
 
-@app.post("/predict/duck-curve")
-def calcular_curva_inteligente(payload: DuckCurveRequest):
+@njit(cache=True)
+def _fuse_duck(curva_shape, perfil_tipico, fator_diurno, gauss_kernel, rad, temp,
+               media_diaria_kwh, pot_gd_final_kw, fator_escala):
+    """
+    Kernel fundido da curva de pato (24h): normaliza e mescla o shape de consumo
+    com o perfil típico, escala para a carga diária, calcula a geração solar
+    com derating térmico e janela diurna, suaviza a geração e obtém a carga líquida.
+    
+    Returns:
+        (curve_consumo, curve_geracao, curve_liquida, min_liquida)
+    """
+    n = curva_shape.shape[0]
+
+    max_val = 0.0
+    for i in range(n):
+        if curva_shape[i] > max_val:
+            max_val = curva_shape[i]
+
+    curva_combinada = np.empty(n)
+    soma = 0.0
+    for i in range(n):
+        shape = curva_shape[i] / max_val if max_val > 0 else 0.5
+        curva_combinada[i] = 0.7 * shape + 0.3 * perfil_tipico[i]
+        soma += curva_combinada[i]
+    if soma == 0:
+        soma = 1.0
+
+    escala = (media_diaria_kwh / soma) * fator_escala
+    curve_consumo = np.empty(n)
+    curve_geracao = np.empty(n)
+    for i in range(n):
+        curve_consumo[i] = curva_combinada[i] * escala
+
+        rad_ratio = rad[i] / 1000.0
+        eficiencia = 1.0 - min(max((temp[i] - 25.0) * 0.004, 0.0), 0.2)
+        curve_geracao[i] = pot_gd_final_kw * rad_ratio * 0.85 * eficiencia * fator_diurno[i]
+
+    # Suavização da geração (FIR de 5 taps, bordas replicadas) + carga líquida
+    raio = gauss_kernel.shape[0] // 2
+    curve_suave = np.empty(n)
+    curve_liquida = np.empty(n)
+    min_liquida = np.inf
+    for i in range(n):
+        acc = 0.0
+        for k in range(gauss_kernel.shape[0]):
+            j = min(max(i + k - raio, 0), n - 1)
+            acc += gauss_kernel[k] * curve_geracao[j]
+        curve_suave[i] = acc
+        curve_liquida[i] = curve_consumo[i] - acc
+        if curve_liquida[i] < min_liquida:
+            min_liquida = curve_liquida[i]
+
+    return curve_consumo, curve_suave, curve_liquida, min_liquida
+
+def _chave_resposta(payload):
+    """Hash determinístico do payload (coordenadas na mesma grade de 4 casas do resolvedor)."""
+    dna = sorted((str(k), str(v)) for k, v in (payload.dna_perfil or {}).items())
+    bruto = (
+        f"{payload.data_alvo}|{round(payload.lat, 4)}|{round(payload.lon, 4)}|"
+        f"{payload.potencia_gd_kw!r}|{payload.consumo_mes_alvo_mwh!r}|{dna}"
+    )
+    return hashlib.blake2b(bruto.encode(), digest_size=16).hexdigest()
+
+@app.post("/predict/duck-curve", response_class=ORJSONResponse)
+async def calcular_curva_inteligente(payload: DuckCurveRequest, request: Request):
+    chave = _chave_resposta(payload)
+    resposta = _resposta_cache.get(chave)
+    if resposta is not None:
+        return ORJSONResponse(resposta)
+
     try:
         # 1. Resolver Local e Data
         sub_nome = resolver_subestacao(payload.lat, payload.lon)
@@ -188,7 +372,8 @@ def calcular_curva_inteligente(payload: DuckCurveRequest):
             dt = datetime.now()
 
         # 2. Definir Consumo Base (Real vs Estimado)
-        consumo_real = buscar_dados_reais_interno(sub_nome, dt.month)
+        # Consulta ao banco é bloqueante: roda no threadpool para não travar o event loop
+        consumo_real = await run_in_threadpool(buscar_dados_reais_interno, sub_nome, dt.month)
         
         # Garantia de float nativo
         if consumo_real is not None and float(consumo_real) > 0:
@@ -215,36 +400,14 @@ def calcular_curva_inteligente(payload: DuckCurveRequest):
 
         # 5. Gerar Shape da Curva
         curva_shape = prever_curva_ml(dt, payload.dna_perfil)
-
-        # Normalização do shape
-        max_val = np.max(curva_shape)
-        if max_val > 0:
-            curva_shape = curva_shape / max_val 
-        else:
-            curva_shape = np.ones(24) * 0.5  
-            
-        perfil_tipico = np.array([
-            0.3, 0.25, 0.2, 0.18, 0.2, 0.3, 0.5, 
-            0.8, 0.9, 0.85, 0.8, 0.75, 0.7,       
-            0.8, 0.9, 1.0, 0.95, 0.9, 0.85,       
-            0.7, 0.6, 0.5, 0.4, 0.35              
-        ])
-        
-        # Mescla shape ML com típico para suavizar
-        curva_combinada = 0.7 * curva_shape + 0.3 * perfil_tipico
-        
-        soma_shape = curva_combinada.sum()
-        if soma_shape == 0: soma_shape = 1
             
         # 6. Processar DNA (Perfil de Carga)
+        # Valores já validados como float na borda da API (DuckCurveRequest)
         dna = payload.dna_perfil or {}
-        try:
-            dna_res = float(dna.get('residencial', 0) or 0)
-            dna_com = float(dna.get('comercial', 0) or 0)
-            dna_ind = float(dna.get('industrial', 0) or 0)
-            dna_rur = float(dna.get('rural', 0) or 0)
-        except:
-            dna_res, dna_com, dna_ind, dna_rur = 0.4, 0.3, 0.3, 0.0
+        dna_res = dna.get('residencial', 0.0)
+        dna_com = dna.get('comercial', 0.0)
+        dna_ind = dna.get('industrial', 0.0)
+        dna_rur = dna.get('rural', 0.0)
 
         soma_dna = dna_res + dna_com + dna_ind + dna_rur
         if soma_dna <= 0:
@@ -259,37 +422,26 @@ def calcular_curva_inteligente(payload: DuckCurveRequest):
         fator_escala = 1.0
         if dna_ind > 0.5: fator_escala = 1.2
         elif dna_res > 0.7: fator_escala = 0.8
-            
-        # CURVA CONSUMO FINAL (array)
-        curve_consumo = curva_combinada * (media_diaria_kwh / soma_shape) * fator_escala
-        
-        # 7. Calcular Geração Solar
-        rad, temp = obter_clima(payload.lat, payload.lon, payload.data_alvo)
-        eficiencia_temp = 1.0 - np.clip((temp - 25.0) * 0.004, 0.0, 0.2)
-        
-        horas = np.arange(24)
-        fator_diurno = np.exp(-((horas - 12) ** 2) / (2 * 4 ** 2))
-        fator_diurno[(horas < 6) | (horas > 19)] = 0
-        
-        # CURVA GERAÇÃO FINAL (array)
-        curve_geracao = pot_gd_final_kw * (rad / 1000.0) * 0.85 * eficiencia_temp * fator_diurno
-        
-        if len(curve_geracao) > 0:
-            curve_geracao = gaussian_filter1d(curve_geracao, sigma=1.0)
         
-        # CURVA LÍQUIDA
-        curve_liquida = curve_consumo - curve_geracao
+        # 7. Calcular Consumo e Geração Solar (kernel fundido)
+        rad, temp = await obter_clima(request.app.state.http, payload.lat, payload.lon, payload.data_alvo)
+        curve_consumo, curve_geracao, curve_liquida, min_liquida = _fuse_duck(
+            curva_shape, PERFIL_TIPICO, FATOR_DIURNO, GAUSS_KERNEL, rad, temp,
+            media_diaria_kwh, pot_gd_final_kw, fator_escala
+        )
         
         # Garantir valor mínimo visual para gráficos
-        min_visivel_val = float(np.min(curve_consumo)) * 0.1
+        min_visivel_val = float(curve_consumo.min()) * 0.1
         min_visivel = max(min_visivel_val, 1.0)
         curve_consumo = np.maximum(curve_consumo, min_visivel)
 
-        # 8. Preparar Resposta (JSON Safe)
-        # Importante: usar .tolist() para arrays numpy e float() para escalares
-        consumo_res_kwh = np.round(curve_consumo * dna_res, 3).tolist()
-        consumo_com_kwh = np.round(curve_consumo * dna_com, 3).tolist()
-        consumo_ind_kwh = np.round(curve_consumo * dna_ind, 3).tolist()
+        # 8. Preparar Resposta
+        # Arrays numpy vão direto para o orjson (OPT_SERIALIZE_NUMPY), sem .tolist();
+        # escalares continuam como float() nativo
+        # Divisão por classe em uma única passada: matriz (3, 24), uma linha por classe.
+        # Linhas (e não colunas) para que cada fatia seja C-contígua, exigência do orjson.
+        consumo_por_classe = np.round(np.outer((dna_res, dna_com, dna_ind), curve_consumo), 3)
+        consumo_res_kwh, consumo_com_kwh, consumo_ind_kwh = consumo_por_classe
 
         consumo_mensal_por_classe = {
             str(int(dt.month)): {
@@ -300,12 +452,12 @@ def calcular_curva_inteligente(payload: DuckCurveRequest):
             }
         }
 
-        return {
+        resposta = {
             "subestacao": sub_nome,
-            "timeline": [f"{h:02d}:00" for h in range(24)],
-            "consumo_kwh": np.round(curve_consumo, 3).tolist(),
-            "geracao_kwh": np.round(curve_geracao, 3).tolist(),
-            "carga_liquida_kwh": np.round(curve_liquida, 3).tolist(),
+            "timeline": TIMELINE,
+            "consumo_kwh": np.round(curve_consumo, 3),
+            "geracao_kwh": np.round(curve_geracao, 3),
+            "carga_liquida_kwh": np.round(curve_liquida, 3),
             "consumo_res_kwh": consumo_res_kwh,
             "consumo_com_kwh": consumo_com_kwh,
             "consumo_ind_kwh": consumo_ind_kwh,
@@ -314,9 +466,15 @@ def calcular_curva_inteligente(payload: DuckCurveRequest):
             "pot_gd_final_kw": float(pot_gd_final_kw),
             "dna_perfil_usado": dna_usado,
             "consumo_mensal_por_classe": consumo_mensal_por_classe,
-            "alerta": bool(np.min(curve_liquida) < 0),
+            "alerta": bool(min_liquida < 0),
             "analise": f"Carga Média: {media_diaria_kwh/24:.0f} kW | GD: {pot_gd_final_kw:.0f} kWp"
         }
+        # Curva montada sobre o clima sintético não entra no cache (mesma regra do obter_clima):
+        # a próxima requisição tenta de novo a Open-Meteo
+        if rad is not FALLBACK_RAD:
+            _resposta_cache[chave] = resposta
+        # Response montada aqui: evita o jsonable_encoder, que não conhece ndarray
+        return ORJSONResponse(resposta)
 
     except Exception as e:
         traceback.print_exc()
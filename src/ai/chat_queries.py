@@ -1,93 +1,342 @@
 import sys
 import os
+import heapq
+import inspect
+import time
+import numpy as np
+from types import MappingProxyType
+from functools import lru_cache, wraps
+from typing import List, Dict, Any, Optional, Tuple, NamedTuple
+
+
+NIVEIS_CRITICIDADE = {"NORMAL": 0, "MÉDIO": 1, "CRÍTICO": 2}
+# Rótulo fora de NIVEIS_CRITICIDADE: cinza no gráfico, mas conta como NORMAL nos filtros de risco
+NIVEL_DESCONHECIDO = 3
+_ORDEM_RISCO = np.array([0, 1, 2, 0], dtype=np.int8)
+
+# Filtro de nivel_minimo: aceita os rótulos da base e os da tool do chat (BAIXO/MEDIO/ALTO)
+_NIVEL_MINIMO = {
+    **NIVEIS_CRITICIDADE,
+    "MEDIO": 1, "CRITICO": 2,
+    "BAIXO": 0, "ALTO": 2,
+}
+
+# Sentinela somente leitura para sub-dicts ausentes (evita alocar {} por item)
+_EMPTY: Dict[str, Any] = {}
+
+
+class _ColunasMercado(NamedTuple):
+    """Métricas numéricas em arrays paralelos (struct-of-arrays), alinhados aos itens."""
+    nomes: np.ndarray
+    total_clientes: np.ndarray
+    consumo_anual_mwh: np.ndarray
+    potencia_total_kw: np.ndarray
+    total_unidades: np.ndarray
+    nivel_criticidade: np.ndarray
+    nomes_cf: Tuple[str, ...]  # nomes em casefold, para busca sem diferenciar caixa
+    nomes_limpos: Tuple[str, ...]  # nome sem o sufixo "(ID: ...)", para rótulos de gráfico
+    indice_nomes: Dict[str, int]  # nome em casefold -> índice (primeira ocorrência)
+    indice_id_tecnico: Dict[str, int]  # id_tecnico -> índice (primeira ocorrência)
+
+
+class _TotaisMercado(NamedTuple):
+    """Totais acumulados numa única passada na montagem do cache."""
+    total_clientes: float
+    consumo_anual_mwh: float
+    potencia_total_kw: float
+    total_unidades: float
+    por_classe: Dict[str, List[float]]  # classe -> [consumo_mwh, qtd_clientes]
+    consumo_classes_mwh: float
+
+
+class _DadosMercado(NamedTuple):
+    itens: Tuple[Dict[str, Any], ...]
+    colunas: _ColunasMercado
+    totais: _TotaisMercado
+
+
+# Versão do cache_mercado reaproveitada por até _VERSAO_TTL_S segundos (uma ida ao banco por janela)
+_VERSAO_TTL_S = 60.0
+_versao_memo: Dict[str, Any] = {"ts": float("-inf"), "valor": None}
+
 
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+def _versao_dados() -> tuple:
+    agora = time.monotonic()
+    if agora - _versao_memo["ts"] >= _VERSAO_TTL_S:
+        from database import obter_versao_cache_mercado
+        _versao_memo["valor"] = obter_versao_cache_mercado()
+        _versao_memo["ts"] = agora
+    return _versao_memo["valor"]
 
-from database import carregar_cache_mercado
-from typing import List, Dict, Any, Optional
 
+def _carregar_dados_mercado() -> _DadosMercado:
+    """
+    Dados de mercado filtrados (itens + colunas), reaproveitados entre chamadas
+    enquanto o cache_mercado não for regravado. Compartilhados: não alterar.
+    """
+    return _filtrar_dados_mercado(_versao_dados())
 
-def _carregar_dados_filtrados() -> List[Dict[str, Any]]:
+
+def _carregar_dados_filtrados() -> Tuple[Dict[str, Any], ...]:
+    return _carregar_dados_mercado().itens
+
+
+@lru_cache(maxsize=1)
+def _filtrar_dados_mercado(versao: tuple) -> _DadosMercado:
+    # 'versao' só compõe a chave do cache (muda a cada regravação do cache_mercado)
+    from database import carregar_cache_mercado
     dados = carregar_cache_mercado()
-    return [
+    itens = tuple(
         d for d in dados 
-        if d.get('metricas_rede', {}).get('total_clientes', 0) > 10
-        and d.get('metricas_rede', {}).get('consumo_anual_mwh', 0) > 0
-    ]
+        if (mr := d.get('metricas_rede') or _EMPTY).get('total_clientes', 0) > 10
+        and mr.get('consumo_anual_mwh', 0) > 0
+    )
+    return _DadosMercado(itens, *_montar_colunas(itens))
+
+
+def _montar_colunas(itens) -> Tuple[_ColunasMercado, _TotaisMercado]:
+    """Preenche as colunas e acumula todos os totais no mesmo laço sobre os itens."""
+    n = len(itens)
+    nomes = np.empty(n, dtype=object)
+    total_clientes = np.zeros(n)
+    consumo = np.zeros(n)
+    potencia = np.zeros(n)
+    unidades = np.zeros(n)
+    nivel = np.zeros(n, dtype=np.int8)
+    nomes_cf = []
+    nomes_limpos = []
+    indice_nomes = {}
+    indice_id_tecnico = {}
+    t_cli = t_cons = t_pot = t_gd = t_classes = 0
+    # perfil_consumo achatado em listas paralelas; classe codificada pela ordem de aparição
+    classe_id: Dict[str, int] = {}
+    classe_codes = []
+    classe_consumos = []
+    classe_clientes = []
+    
+    for i, d in enumerate(itens):
+        # .get ligado uma vez por item: sem LOAD_ATTR repetido nas leituras abaixo
+        d_get = d.get
+        mr_get = (d_get('metricas_rede') or _EMPTY).get
+        gd_get = (d_get('geracao_distribuida') or _EMPTY).get
+        nomes[i] = d_get('subestacao', 'Desconhecida')
+        nomes_limpos.append(str(nomes[i]).split("(ID:", 1)[0].strip())
+        nome_cf = (d_get('subestacao') or '').casefold()
+        nomes_cf.append(nome_cf)
+        indice_nomes.setdefault(nome_cf, i)
+        indice_id_tecnico.setdefault(d_get('id_tecnico'), i)
+        cli = mr_get('total_clientes', 0) or 0
+        cons = mr_get('consumo_anual_mwh', 0) or 0
+        pot = gd_get('potencia_total_kw', 0) or 0
+        uni = gd_get('total_unidades', 0) or 0
+        total_clientes[i] = cli
+        consumo[i] = cons
+        potencia[i] = pot
+        unidades[i] = uni
+        nivel[i] = NIVEIS_CRITICIDADE.get(mr_get('nivel_criticidade_gd', 'NORMAL'), NIVEL_DESCONHECIDO)
+        
+        t_cli += cli
+        t_cons += cons
+        t_pot += pot
+        t_gd += uni
+        
+        for classe, info in (d_get('perfil_consumo') or _EMPTY).items():
+            info_get = info.get
+            consumo_mwh = info_get('consumo_anual_mwh', 0)
+            classe_codes.append(classe_id.setdefault(classe, len(classe_id)))
+            classe_consumos.append(consumo_mwh)
+            classe_clientes.append(info_get('qtd_clientes', 0))
+            t_classes += consumo_mwh
+    
+    colunas = _ColunasMercado(
+        nomes, total_clientes, consumo, potencia, unidades, nivel,
+        tuple(nomes_cf), tuple(nomes_limpos), indice_nomes, indice_id_tecnico
+    )
+    # Soma por classe: scatter-add compilado (bincount) sobre os códigos
+    codes = np.asarray(classe_codes, dtype=np.intp)
+    consumo_cls = np.bincount(codes, weights=np.asarray(classe_consumos, dtype=np.float64),
+                              minlength=len(classe_id))
+    clientes_cls = np.zeros(len(classe_id), dtype=np.int64)
+    np.add.at(clientes_cls, codes, np.asarray(classe_clientes, dtype=np.int64))
+    por_classe = {
+        classe: [c, q]
+        for classe, c, q in zip(classe_id, consumo_cls.tolist(), clientes_cls.tolist())
+    }
+    
+    totais = _TotaisMercado(t_cli, t_cons, t_pot, t_gd, por_classe, t_classes)
+    return colunas, totais
+
+
+def _localizar_subestacao(nome: str, col: _ColunasMercado) -> Optional[int]:
+    """
+    Índice da subestação pelo nome: nome exato via hash e, se não houver,
+    a primeira cujo nome (casefold, pré-calculado) contém o termo buscado.
+    """
+    termo = nome.casefold()
+    i = col.indice_nomes.get(termo)
+    if i is not None:
+        return i
+    for i, nome_sub in enumerate(col.nomes_cf):
+        if termo in nome_sub:
+            return i
+    return None
+
+
+def invalidar_cache_dados() -> None:
+    """Descarta dados e resultados em memória (próxima chamada relê o banco)."""
+    _versao_memo["ts"] = float("-inf")
+    _filtrar_dados_mercado.cache_clear()
+    for limpar in _LIMPEZAS_CACHE:
+        limpar()
 
+
+class _ResultadoComErro(Exception):
+    """Resultado de erro de uma consulta: devolvido ao chamador, mas nunca cacheado."""
+
+
+def _tem_erro(resultado: Any) -> bool:
+    if isinstance(resultado, list):
+        return bool(resultado) and isinstance(resultado[0], dict) and "erro" in resultado[0]
+    return isinstance(resultado, dict) and "erro" in resultado
+
+
+_LIMPEZAS_CACHE: List[Any] = []
+
+
+def _em_cache_por_versao(func):
+    """
+    Memoiza o resultado de uma consulta/gráfico por (argumentos normalizados,
+    versão do cache_mercado). Cada chamada recebe uma cópia rasa do dict/lista
+    (os sub-dicts são compartilhados: não alterar); respostas com "erro" não
+    entram no cache. Se a memoização falhar (ex.: argumento não hasheável),
+    a função é chamada direto.
+    """
+    assinatura = inspect.signature(func)
+
+    @lru_cache(maxsize=32)
+    def _memo(versao, *args):
+        resultado = func(*args)
+        if _tem_erro(resultado):
+            raise _ResultadoComErro(resultado)
+        return resultado
+
+    _LIMPEZAS_CACHE.append(_memo.cache_clear)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            chamada = assinatura.bind(*args, **kwargs)
+            chamada.apply_defaults()
+            resultado = _memo(_versao_dados(), *chamada.args)
+        except _ResultadoComErro as e:
+            return e.args[0]
+        except Exception:
+            return func(*args, **kwargs)
+        return type(resultado)(resultado) if isinstance(resultado, (dict, list)) else resultado
+
+    return wrapper
+
+
+def _ranking(criterio: str, ordem: str, limite: int):
+    """Índices do ranking sobre as colunas: (colunas, índices, valores, unidade)."""
+    col = _carregar_dados_mercado().colunas
+    
+    if criterio.lower() == "consumo":
+        valores = col.consumo_anual_mwh
+        unidade = "MWh/ano"
+    else:
+        valores = col.potencia_total_kw
+        unidade = "kW"
+    
+    # argsort estável: empates mantêm a ordem original, como no sort do Python
+    chave = -valores if ordem.lower() == "desc" else valores
+    return col, _menores_k(chave, limite), valores, unidade
+
+
+def _menores_k(chave: np.ndarray, k: int) -> np.ndarray:
+    """
+    Equivale a np.argsort(chave, kind='stable')[:k], mas para k pequeno só
+    ordena os candidatos até o k-ésimo valor (partition O(N) + sort de ~k).
+    """
+    if not 0 < k < chave.size:
+        return np.argsort(chave, kind='stable')[:k]
+    limiar = np.partition(chave, k - 1)[k - 1]
+    if np.isnan(limiar):
+        return np.argsort(chave, kind='stable')[:k]
+    candidatos = np.flatnonzero(chave <= limiar)  # em ordem original: empates preservados
+    return candidatos[np.argsort(chave[candidatos], kind='stable')][:k]
+
+
+@_em_cache_por_versao
 def obter_ranking_subestacoes(
     criterio: str = "consumo", 
     ordem: str = "desc", 
     limite: int = 5
 ) -> List[Dict[str, Any]]:
     try:
-        dados = _carregar_dados_filtrados()
-        
-        resultados = []
-        for item in dados:
-            nome = item.get('subestacao', 'Desconhecida')
-            clientes = item.get('metricas_rede', {}).get('total_clientes', 0)
-            
-            if criterio.lower() == "consumo":
-                valor = item.get('metricas_rede', {}).get('consumo_anual_mwh', 0)
-                unidade = "MWh/ano"
-            else:
-                valor = item.get('geracao_distribuida', {}).get('potencia_total_kw', 0)
-                unidade = "kW"
-            
-            resultados.append({
+        col, indices, valores, unidade = _ranking(criterio, ordem, limite)
+        
+        # Conversão para tipos nativos numa chamada por coluna (tolist), não por item
+        return [
+            {
                 "nome": nome,
-                "valor": float(valor),
+                "valor": valor,
                 "unidade": unidade,
-                "total_clientes": int(clientes)
-            })
-        
-        resultados.sort(key=lambda x: x['valor'], reverse=(ordem.lower() == "desc"))
-        
-        return resultados[:limite]
+                "total_clientes": clientes
+            }
+            for nome, valor, clientes in zip(
+                col.nomes[indices].tolist(),
+                valores[indices].tolist(),
+                col.total_clientes[indices].astype(np.int64).tolist()
+            )
+        ]
         
     except Exception as e:
         return [{"erro": f"Erro ao buscar ranking: {str(e)}"}]
 
 
+@_em_cache_por_versao
 def obter_subestacoes_em_risco(nivel_minimo: str = "MEDIO") -> List[Dict[str, Any]]:
     try:
-        dados = _carregar_dados_filtrados()
+        dados, col, _ = _carregar_dados_mercado()
         
-        niveis_ordem = {"NORMAL": 0, "MÉDIO": 1, "CRÍTICO": 2}
-        min_nivel = niveis_ordem.get(nivel_minimo.upper(), 1)
+        min_nivel = _NIVEL_MINIMO.get(nivel_minimo.upper(), 1)
         
-        resultados = []
-        for item in dados:
-            nivel = item.get('metricas_rede', {}).get('nivel_criticidade_gd', 'NORMAL')
-            
-            if niveis_ordem.get(nivel, 0) >= min_nivel:
-                resultados.append({
-                    "nome": item.get('subestacao', 'Desconhecida'),
-                    "nivel_risco": nivel,
-                    "potencia_gd_kw": float(item.get('geracao_distribuida', {}).get('potencia_total_kw', 0)),
-                    "num_unidades_gd": int(item.get('geracao_distribuida', {}).get('total_unidades', 0)),
-                    "total_clientes": int(item.get('metricas_rede', {}).get('total_clientes', 0))
-                })
+        indices = np.flatnonzero(_ORDEM_RISCO[col.nivel_criticidade] >= min_nivel)
+        indices = indices[np.argsort(-col.potencia_total_kw[indices], kind='stable')]
         
-        resultados.sort(key=lambda x: x['potencia_gd_kw'], reverse=True)
-        
-        return resultados
+        return [
+            {
+                "nome": nome,
+                "nivel_risco": (dados[i].get('metricas_rede') or _EMPTY).get('nivel_criticidade_gd', 'NORMAL'),
+                "potencia_gd_kw": potencia,
+                "num_unidades_gd": unidades,
+                "total_clientes": clientes
+            }
+            for i, nome, potencia, unidades, clientes in zip(
+                indices.tolist(),
+                col.nomes[indices].tolist(),
+                col.potencia_total_kw[indices].tolist(),
+                col.total_unidades[indices].astype(np.int64).tolist(),
+                col.total_clientes[indices].astype(np.int64).tolist()
+            )
+        ]
         
     except Exception as e:
         return [{"erro": f"Erro ao buscar subestações em risco: {str(e)}"}]
 
 
+@_em_cache_por_versao
 def obter_estatisticas_gerais() -> Dict[str, Any]:
     try:
-        dados_cache = _carregar_dados_filtrados()
+        dados, _, tot = _carregar_dados_mercado()
         
-        # Todas as estatísticas vêm do cache (já filtrado por cidade)
-        total_subs = len(dados_cache)
-        total_cons = sum(d.get('metricas_rede', {}).get('total_clientes', 0) for d in dados_cache)
-        total_gd = sum(d.get('geracao_distribuida', {}).get('total_unidades', 0) for d in dados_cache)
-        pot_total = sum(d.get('geracao_distribuida', {}).get('potencia_total_kw', 0) for d in dados_cache)
-        consumo_total = sum(d.get('metricas_rede', {}).get('consumo_anual_mwh', 0) for d in dados_cache)
+        # Todas as estatísticas vêm do cache (já filtrado por cidade); totais pré-acumulados
+        total_subs = len(dados)
+        total_cons = tot.total_clientes
+        total_gd = tot.total_unidades
+        pot_total = tot.potencia_total_kw
+        consumo_total = tot.consumo_anual_mwh
         
         return {
             "total_subestacoes": int(total_subs),
@@ -102,16 +351,21 @@ def obter_estatisticas_gerais() -> Dict[str, Any]:
 
 
 def buscar_subestacao_detalhes(nome: str) -> Optional[Dict[str, Any]]:
+    # A busca ignora caixa: "Sub X" e "SUB X" compartilham a mesma entrada do cache
+    termo = nome.casefold() if isinstance(nome, str) else nome
+    return _detalhes_subestacao(termo)
+
+
+@_em_cache_por_versao
+def _detalhes_subestacao(nome: str) -> Optional[Dict[str, Any]]:
     try:
-        dados = _carregar_dados_filtrados()
-        
-        nome_upper = nome.upper()
+        dados, col, _ = _carregar_dados_mercado()
         
-        for item in dados:
-            nome_sub = item.get('subestacao', '').upper()
-            if nome_upper in nome_sub:
-                item_clean = {k: v for k, v in item.items() if k != 'geometry'}
-                return item_clean
+        i = _localizar_subestacao(nome, col)
+        if i is not None:
+            item_clean = dados[i].copy()  # cópia da tabela em C; só a chave geometry sai
+            item_clean.pop('geometry', None)
+            return item_clean
         
         return None
         
@@ -119,34 +373,21 @@ def buscar_subestacao_detalhes(nome: str) -> Optional[Dict[str, Any]]:
         return {"erro": f"Erro ao buscar subestação: {str(e)}"}
 
 
+@_em_cache_por_versao
 def obter_distribuicao_consumo_por_classe() -> Dict[str, Any]:
     try:
-        dados = _carregar_dados_filtrados()
-        
-        classes = {}
-        consumo_total_geral = 0
-        
-        for item in dados:
-            perfil = item.get('perfil_consumo', {})
-            for classe, info in perfil.items():
-                consumo_mwh = info.get('consumo_anual_mwh', 0)
-                qtd_clientes = info.get('qtd_clientes', 0)
-                
-                if classe not in classes:
-                    classes[classe] = {"consumo_mwh": 0, "qtd_clientes": 0}
-                
-                classes[classe]["consumo_mwh"] += consumo_mwh
-                classes[classe]["qtd_clientes"] += qtd_clientes
-                consumo_total_geral += consumo_mwh
-        
-        resultado = {}
-        for classe, dados in classes.items():
-            pct = (dados["consumo_mwh"] / consumo_total_geral * 100) if consumo_total_geral > 0 else 0
-            resultado[classe] = {
-                "consumo_anual_mwh": float(dados["consumo_mwh"]),
-                "percentual": float(pct),
-                "qtd_clientes": int(dados["qtd_clientes"])
+        tot = _carregar_dados_mercado().totais
+        
+        consumo_total_geral = tot.consumo_classes_mwh
+        
+        resultado = {
+            classe: {
+                "consumo_anual_mwh": float(consumo_mwh),
+                "percentual": float(consumo_mwh / consumo_total_geral * 100) if consumo_total_geral > 0 else 0.0,
+                "qtd_clientes": int(qtd_clientes)
             }
+            for classe, (consumo_mwh, qtd_clientes) in tot.por_classe.items()
+        }
         
         return {
             "distribuicao": resultado,
@@ -160,35 +401,44 @@ def obter_distribuicao_consumo_por_classe() -> Dict[str, Any]:
 def comparar_subestacoes(nomes: List[str]) -> List[Dict[str, Any]]:
     """Compara 2 ou mais subestações lado a lado"""
     try:
-        dados = _carregar_dados_filtrados()
-        
-        resultados = []
-        for nome_busca in nomes:
-            nome_upper = nome_busca.upper()
-            for item in dados:
-                nome_sub = item.get('subestacao', '').upper()
-                if nome_upper in nome_sub:
-                    resultados.append({
-                        "nome": item.get('subestacao', 'Desconhecida'),
-                        "consumo_anual_mwh": float(item.get('metricas_rede', {}).get('consumo_anual_mwh', 0)),
-                        "total_clientes": int(item.get('metricas_rede', {}).get('total_clientes', 0)),
-                        "potencia_gd_kw": float(item.get('geracao_distribuida', {}).get('potencia_total_kw', 0)),
-                        "unidades_gd": int(item.get('geracao_distribuida', {}).get('total_unidades', 0)),
-                        "nivel_criticidade": item.get('metricas_rede', {}).get('nivel_criticidade_gd', 'NORMAL'),
-                        "consumo_medio_kwh_cliente": float(item.get('metricas_rede', {}).get('consumo_anual_mwh', 0) * 1000 / max(item.get('metricas_rede', {}).get('total_clientes', 1), 1))
-                    })
-                    break
-        
-        return resultados
+        dados, col, _ = _carregar_dados_mercado()
+        
+        indices = [i for i in (_localizar_subestacao(n, col) for n in nomes) if i is not None]
+        idx = np.asarray(indices, dtype=np.intp)
+        
+        # Consumo médio de todos os itens pedidos numa única operação vetorizada
+        consumo_medio = col.consumo_anual_mwh[idx] * 1000.0 / np.maximum(col.total_clientes[idx], 1)
+        
+        return [
+            {
+                "nome": nome,
+                "consumo_anual_mwh": consumo,
+                "total_clientes": clientes,
+                "potencia_gd_kw": potencia,
+                "unidades_gd": unidades,
+                "nivel_criticidade": (dados[i].get('metricas_rede') or _EMPTY).get('nivel_criticidade_gd', 'NORMAL'),
+                "consumo_medio_kwh_cliente": medio
+            }
+            for i, nome, consumo, clientes, potencia, unidades, medio in zip(
+                indices,
+                col.nomes[idx].tolist(),
+                col.consumo_anual_mwh[idx].tolist(),
+                col.total_clientes[idx].astype(np.int64).tolist(),
+                col.potencia_total_kw[idx].tolist(),
+                col.total_unidades[idx].astype(np.int64).tolist(),
+                consumo_medio.tolist()
+            )
+        ]
         
     except Exception as e:
         return [{"erro": f"Erro ao comparar subestações: {str(e)}"}]
 
 
+@_em_cache_por_versao
 def obter_insights_inteligentes() -> Dict[str, Any]:
     """Retorna insights automáticos baseados na análise dos dados"""
     try:
-        dados = _carregar_dados_filtrados()
+        dados, col, tot = _carregar_dados_mercado()
         
         insights = {
             "alertas": [],
@@ -196,26 +446,29 @@ def obter_insights_inteligentes() -> Dict[str, Any]:
             "destaques": []
         }
         
-        subs_alto_gd = [d for d in dados if d.get('metricas_rede', {}).get('nivel_criticidade_gd') == 'CRÍTICO']
-        if subs_alto_gd:
+        # Alertas e oportunidades saem das colunas (máscaras); nenhuma passada sobre os dicts
+        idx_critico = np.flatnonzero(col.nivel_criticidade == NIVEIS_CRITICIDADE["CRÍTICO"])
+        if idx_critico.size:
             insights["alertas"].append({
                 "tipo": "CRITICIDADE_GD",
-                "mensagem": f"{len(subs_alto_gd)} subestação(ões) com criticidade ALTA de GD",
-                "subestacoes": [s.get('subestacao') for s in subs_alto_gd[:3]]
+                "mensagem": f"{idx_critico.size} subestação(ões) com criticidade ALTA de GD",
+                "subestacoes": [dados[i].get('subestacao') for i in idx_critico[:3]]
             })
         
-        dados_sorted = sorted(dados, key=lambda x: x.get('metricas_rede', {}).get('consumo_anual_mwh', 0), reverse=True)
-        if dados_sorted:
-            top_consumo = dados_sorted[0]
+        if dados:
+            # argmax devolve a primeira ocorrência do máximo; total já vem pré-acumulado
+            i_top = int(np.argmax(col.consumo_anual_mwh))
+            consumo_top = float(col.consumo_anual_mwh[i_top])
+            total_consumo = tot.consumo_anual_mwh
             insights["destaques"].append({
                 "tipo": "MAIOR_CONSUMO",
-                "subestacao": top_consumo.get('subestacao'),
-                "valor": float(top_consumo.get('metricas_rede', {}).get('consumo_anual_mwh', 0)),
-                "percentual_do_total": round(top_consumo.get('metricas_rede', {}).get('consumo_anual_mwh', 0) / sum(d.get('metricas_rede', {}).get('consumo_anual_mwh', 0) for d in dados) * 100, 1) if dados else 0
+                "subestacao": dados[i_top].get('subestacao'),
+                "valor": consumo_top,
+                "percentual_do_total": round(consumo_top / total_consumo * 100, 1) if total_consumo else 0
             })
         
-        total_clientes = sum(d.get('metricas_rede', {}).get('total_clientes', 0) for d in dados)
-        total_unidades_gd = sum(d.get('geracao_distribuida', {}).get('total_unidades', 0) for d in dados)
+        total_clientes = tot.total_clientes
+        total_unidades_gd = tot.total_unidades
         if total_clientes > 0:
             taxa_penetracao = (total_unidades_gd / total_clientes) * 100
             insights["destaques"].append({
@@ -225,12 +478,12 @@ def obter_insights_inteligentes() -> Dict[str, Any]:
                 "total_clientes": int(total_clientes)
             })
         
-        subs_baixo_gd = [d for d in dados if d.get('geracao_distribuida', {}).get('total_unidades', 0) < 10 and d.get('metricas_rede', {}).get('total_clientes', 0) > 1000]
-        if subs_baixo_gd:
+        idx_baixo_gd = np.flatnonzero((col.total_unidades < 10) & (col.total_clientes > 1000))
+        if idx_baixo_gd.size:
             insights["oportunidades"].append({
                 "tipo": "EXPANSAO_GD",
-                "mensagem": f"{len(subs_baixo_gd)} subestação(ões) com potencial para expansão de GD",
-                "subestacoes": [s.get('subestacao') for s in subs_baixo_gd[:3]]
+                "mensagem": f"{idx_baixo_gd.size} subestação(ões) com potencial para expansão de GD",
+                "subestacoes": [dados[i].get('subestacao') for i in idx_baixo_gd[:3]]
             })
         
         return insights
@@ -243,22 +496,24 @@ def analisar_territorio(nome_subestacao: str) -> Dict[str, Any]:
     """Analisa o território Voronoi de uma subestação"""
     try:
         from database import carregar_voronoi, carregar_subestacoes
-        import geopandas as gpd
         
         gdf_voronoi = carregar_voronoi()
         gdf_subs = carregar_subestacoes()
         
-        nome_upper = nome_subestacao.upper()
-        subestacao = None
-        for idx, row in gdf_subs.iterrows():
-            if nome_upper in str(row.get('NOM', '')).upper():
-                subestacao = row
-                cod_id = row.get('COD_ID')
-                break
+        if 'NOM' not in gdf_subs:
+            return {"erro": "Subestação não encontrada"}
+        
+        termo = nome_subestacao.casefold()
+        encontrados = np.flatnonzero(
+            gdf_subs['NOM'].astype(str).str.casefold().str.contains(termo, regex=False).to_numpy()
+        )
         
-        if subestacao is None:
+        if len(encontrados) == 0:
             return {"erro": "Subestação não encontrada"}
         
+        subestacao = gdf_subs.iloc[int(encontrados[0])]
+        cod_id = subestacao.get('COD_ID')
+        
         territorio = gdf_voronoi[gdf_voronoi['COD_ID'] == cod_id]
         
         if territorio.empty:
@@ -268,18 +523,16 @@ def analisar_territorio(nome_subestacao: str) -> Dict[str, Any]:
         area_m2 = territorio_proj.geometry.area.iloc[0]
         area_km2 = area_m2 / 1_000_000
         
-        dados_mercado = _carregar_dados_filtrados()
-        dados_sub = None
-        for item in dados_mercado:
-            if item.get('id_tecnico') == str(cod_id):
-                dados_sub = item
-                break
+        dados_mercado, col, _ = _carregar_dados_mercado()
+        i = col.indice_id_tecnico.get(str(cod_id))
+        dados_sub = dados_mercado[i] if i is not None else None
         
+        mr = (dados_sub.get('metricas_rede') or _EMPTY) if dados_sub else None
         resultado = {
             "nome": subestacao.get('NOM', 'Desconhecida'),
             "area_km2": round(area_km2, 2),
-            "total_clientes": int(dados_sub.get('metricas_rede', {}).get('total_clientes', 0)) if dados_sub else 0,
-            "consumo_anual_mwh": float(dados_sub.get('metricas_rede', {}).get('consumo_anual_mwh', 0)) if dados_sub else 0
+            "total_clientes": int(mr.get('total_clientes', 0)) if dados_sub else 0,
+            "consumo_anual_mwh": float(mr.get('consumo_anual_mwh', 0)) if dados_sub else 0
         }
         
         if area_km2 > 0:
@@ -296,69 +549,64 @@ def buscar_subestacoes_proximas(nome_referencia: str, limite: int = 5) -> List[D
     """Encontra subestações próximas a uma subestação de referência"""
     try:
         from database import carregar_subestacoes
-        import numpy as np
         
         gdf_subs = carregar_subestacoes()
         
-        nome_upper = nome_referencia.upper()
-        sub_ref = None
-        for idx, row in gdf_subs.iterrows():
-            if nome_upper in str(row.get('NOM', '')).upper():
-                sub_ref = row
-                break
+        if 'NOM' not in gdf_subs:
+            return [{"erro": "Subestação de referência não encontrada"}]
+        
+        termo = nome_referencia.casefold()
+        nomes = gdf_subs['NOM'].to_numpy()
+        encontrados = np.flatnonzero(
+            gdf_subs['NOM'].astype(str).str.casefold().str.contains(termo, regex=False).to_numpy()
+        )
         
-        if sub_ref is None:
+        if len(encontrados) == 0:
             return [{"erro": "Subestação de referência não encontrada"}]
         
-        gdf_proj = gdf_subs.to_crs('EPSG:31984')
-        ponto_ref = gdf_proj[gdf_proj['COD_ID'] == sub_ref['COD_ID']].geometry.iloc[0]
+        codigos = gdf_subs['COD_ID'].to_numpy()
+        cod_ref = codigos[encontrados[0]]
         
-        distancias = []
-        for idx, row in gdf_proj.iterrows():
-            if row['COD_ID'] != sub_ref['COD_ID']:
-                dist_m = ponto_ref.distance(row.geometry)
-                dist_km = dist_m / 1000
-                distancias.append({
-                    "nome": row.get('NOM', 'Desconhecida'),
-                    "distancia_km": round(dist_km, 2)
-                })
+        gdf_proj = gdf_subs.to_crs('EPSG:31984')
+        ponto_ref = gdf_proj.geometry.iloc[int(np.flatnonzero(codigos == cod_ref)[0])]
         
-        distancias.sort(key=lambda x: x['distancia_km'])
+        # Uma única chamada vetorizada do shapely para todas as distâncias
+        dist_km = np.round(gdf_proj.geometry.distance(ponto_ref).to_numpy() / 1000, 2)
+        candidatos = np.flatnonzero(codigos != cod_ref)
+        candidatos = candidatos[np.argsort(dist_km[candidatos], kind='stable')][:limite]
         
-        return distancias[:limite]
+        return [
+            {"nome": nomes[i], "distancia_km": float(dist_km[i])}
+            for i in candidatos
+        ]
         
     except Exception as e:
         return [{"erro": f"Erro ao buscar subestações próximas: {str(e)}"}]
 
 
+@_em_cache_por_versao
 def obter_metricas_performance() -> Dict[str, Any]:
     """Retorna métricas de performance do sistema elétrico"""
     try:
-        dados = _carregar_dados_filtrados()
+        dados, _, tot = _carregar_dados_mercado()
         
-        total_clientes = sum(d.get('metricas_rede', {}).get('total_clientes', 0) for d in dados)
-        total_consumo = sum(d.get('metricas_rede', {}).get('consumo_anual_mwh', 0) for d in dados)
-        total_unidades_gd = sum(d.get('geracao_distribuida', {}).get('total_unidades', 0) for d in dados)
-        total_potencia_gd = sum(d.get('geracao_distribuida', {}).get('potencia_total_kw', 0) for d in dados)
+        total_clientes = tot.total_clientes
+        total_consumo = tot.consumo_anual_mwh
+        total_unidades_gd = tot.total_unidades
+        total_potencia_gd = tot.potencia_total_kw
         
         consumo_medio_anual = (total_consumo * 1000 / total_clientes) if total_clientes > 0 else 0  # kWh
         consumo_medio_mensal = consumo_medio_anual / 12
         
         taxa_penetracao_gd = (total_unidades_gd / total_clientes * 100) if total_clientes > 0 else 0
         
+        # Acumulado por classe vem pronto do cache; aqui só monta dicts novos
         consumo_por_classe = {}
-        for item in dados:
-            perfil = item.get('perfil_consumo', {})
-            for classe, info in perfil.items():
-                if classe not in consumo_por_classe:
-                    consumo_por_classe[classe] = {"consumo": 0, "clientes": 0}
-                consumo_por_classe[classe]["consumo"] += info.get('consumo_anual_mwh', 0)
-                consumo_por_classe[classe]["clientes"] += info.get('qtd_clientes', 0)
-        
-        for classe, dados_classe in consumo_por_classe.items():
-            if dados_classe["clientes"] > 0:
+        for classe, (consumo_classe, clientes_classe) in tot.por_classe.items():
+            consumo_por_classe[classe] = {"consumo": consumo_classe, "clientes": clientes_classe}
+            if clientes_classe > 0:
                 consumo_por_classe[classe]["consumo_medio_kwh_ano"] = round(
-                    dados_classe["consumo"] * 1000 / dados_classe["clientes"], 1
+                    consumo_classe * 1000 / clientes_classe, 1
                 )
         
         return {
@@ -377,14 +625,16 @@ def obter_metricas_performance() -> Dict[str, Any]:
 
 
 # ==================== FUNÇÕES DE GRÁFICOS ====================
-
-import plotly.graph_objects as go
-import plotly.express as px
+# plotly é importado dentro de cada gerador: só paga o import quem pede gráfico
 
 
+@_em_cache_por_versao
 def gerar_grafico_consumo_por_classe() -> Dict[str, Any]:
     """Gera gráfico de pizza do consumo por classe"""
     try:
+        import plotly.graph_objects as go
+        import plotly.express as px
+        
         dados = obter_distribuicao_consumo_por_classe()
         
         if "erro" in dados:
@@ -420,68 +670,91 @@ def gerar_grafico_consumo_por_classe() -> Dict[str, Any]:
         return {"erro": f"Erro ao gerar gráfico: {str(e)}"}
 
 
+@lru_cache(maxsize=1)
+def _modelo_grafico_ranking() -> Dict[str, Any]:
+    """
+    Figura-modelo do ranking (barra horizontal, Viridis, template padrão) validada
+    pelo Plotly uma única vez e guardada como dict. Compartilhada: não alterar.
+    """
+    import plotly.graph_objects as go
+    fig = go.Figure(data=[go.Bar(
+        orientation='h',
+        marker=dict(colorscale='Viridis', showscale=True),
+        textposition='auto'
+    )])
+    fig.update_layout(
+        yaxis_title="Subestação",
+        yaxis={'categoryorder':'total ascending'}
+    )
+    return fig.to_plotly_json()
+
+
+@_em_cache_por_versao
 def gerar_grafico_ranking_subestacoes(
     criterio: str = "consumo",
     limite: int = 10
 ) -> Dict[str, Any]:
     """Gera gráfico de barras do ranking de subestações"""
     try:
-        dados = obter_ranking_subestacoes(criterio, "desc", limite)
+        import plotly.io as pio
         
-        if not dados or "erro" in dados[0]:
+        try:
+            col, indices, valores_col, unidade = _ranking(criterio, "desc", limite)
+        except Exception:
             return {"erro": "Erro ao buscar dados"}
         
-        nomes = [d["nome"].split("(ID:")[0].strip() for d in dados]
-        valores = [d["valor"] for d in dados]
-        unidade = dados[0]["unidade"]
+        if len(indices) == 0:
+            return {"erro": "Erro ao buscar dados"}
         
-        fig = go.Figure(data=[go.Bar(
-            x=valores,
-            y=nomes,
-            orientation='h',
-            marker=dict(
-                color=valores,
-                colorscale='Viridis',
-                showscale=True
-            ),
-            text=[f"{v:.1f} {unidade}" for v in valores],
-            textposition='auto'
-        )])
+        nomes = [col.nomes_limpos[i] for i in indices]
+        valores = valores_col[indices].tolist()
         
         titulo = f"Top {limite} Subestações - {'Consumo' if criterio == 'consumo' else 'Geração Distribuída'}"
         
-        fig.update_layout(
-            title=titulo,
-            xaxis_title=f"Valor ({unidade})",
-            yaxis_title="Subestação",
-            height=max(400, limite * 40),
-            yaxis={'categoryorder':'total ascending'}
-        )
+        # Só x/y/texto/título/altura variam: preenche a figura-modelo já validada
+        base = _modelo_grafico_ranking()
+        barra = base["data"][0]
+        fig = {
+            "data": [{
+                **barra,
+                "x": valores,
+                "y": nomes,
+                "marker": {**barra["marker"], "color": valores},
+                "text": [f"{v:.1f} {unidade}" for v in valores]
+            }],
+            "layout": {
+                **base["layout"],
+                "title": {"text": titulo},
+                "xaxis": {"title": {"text": f"Valor ({unidade})"}},
+                "height": max(400, limite * 40)
+            }
+        }
         
         return {
             "tipo": "plotly",
-            "spec": fig.to_json(),
+            "spec": pio.to_json(fig, validate=False),
             "titulo": titulo
         }
     except Exception as e:
         return {"erro": f"Erro ao gerar gráfico: {str(e)}"}
 
 
+@_em_cache_por_versao
 def gerar_grafico_distribuicao_gd() -> Dict[str, Any]:
     """Gera gráfico de barras da distribuição de GD por subestação"""
     try:
-        dados = _carregar_dados_filtrados()
+        import plotly.graph_objects as go
         
-        # Ordena por potência GD
-        dados_sorted = sorted(
-            dados,
-            key=lambda x: x.get('geracao_distribuida', {}).get('potencia_total_kw', 0),
-            reverse=True
-        )[:15]  # Top 15
+        dados, col, _ = _carregar_dados_mercado()
         
-        nomes = [d['subestacao'].split("(ID:")[0].strip() for d in dados_sorted]
-        potencias = [d.get('geracao_distribuida', {}).get('potencia_total_kw', 0) for d in dados_sorted]
-        qtds = [d.get('geracao_distribuida', {}).get('total_unidades', 0) for d in dados_sorted]
+        # Top 15 por potência GD (heap de tamanho 15, sem ordenar a lista toda)
+        # Chave em C (ndarray.item devolve float nativo): sem lambda por elemento
+        indices = heapq.nlargest(15, range(len(dados)), key=col.potencia_total_kw.item)
+        
+        nomes = [col.nomes_limpos[i] for i in indices]
+        gds = [dados[i].get('geracao_distribuida') or _EMPTY for i in indices]
+        potencias = [gd.get('potencia_total_kw', 0) for gd in gds]
+        qtds = [gd.get('total_unidades', 0) for gd in gds]
         
         fig = go.Figure()
         
@@ -522,38 +795,26 @@ def gerar_grafico_distribuicao_gd() -> Dict[str, Any]:
         return {"erro": f"Erro ao gerar gráfico: {str(e)}"}
 
 
+@_em_cache_por_versao
 def gerar_grafico_criticidade_vs_consumo() -> Dict[str, Any]:
     """Gera scatter plot de criticidade GD vs consumo"""
     try:
-        dados = _carregar_dados_filtrados()
-        
-        consumos = []
-        gd_percentuais = []
-        nomes = []
-        cores = []
-        tamanhos = []
-        
-        mapa_cores = {"NORMAL": "green", "MÉDIO": "orange", "CRÍTICO": "red"}
-        
-        for d in dados:
-            total_cli = d.get('metricas_rede', {}).get('total_clientes', 0)
-            if total_cli < 100:
-                continue
-                
-            consumo = d.get('metricas_rede', {}).get('consumo_anual_mwh', 0)
-            gd_unidades = d.get('geracao_distribuida', {}).get('total_unidades', 0)
-            nivel = d.get('metricas_rede', {}).get('nivel_criticidade_gd', 'NORMAL')
-            
-            if total_cli > 0:
-                gd_pct = (gd_unidades / total_cli) * 100
-            else:
-                gd_pct = 0
-            
-            consumos.append(consumo)
-            gd_percentuais.append(gd_pct)
-            nomes.append(d['subestacao'].split("(ID:")[0].strip())
-            cores.append(mapa_cores.get(nivel, "gray"))
-            tamanhos.append(total_cli / 50)
+        import plotly.graph_objects as go
+        
+        col = _carregar_dados_mercado().colunas
+        
+        # Cores indexadas pelo código de criticidade (NIVEIS_CRITICIDADE; NIVEL_DESCONHECIDO em cinza)
+        cores_por_nivel = np.array(["green", "orange", "red", "gray"], dtype=object)
+        
+        # Só subestações com pelo menos 100 clientes (logo, divisor sempre > 0)
+        indices = np.flatnonzero(col.total_clientes >= 100)
+        total_cli = col.total_clientes[indices]
+        
+        consumos = col.consumo_anual_mwh[indices].tolist()
+        gd_percentuais = (col.total_unidades[indices] / total_cli * 100).tolist()
+        nomes = [col.nomes_limpos[i] for i in indices]
+        cores = cores_por_nivel[col.nivel_criticidade[indices]].tolist()
+        tamanhos = (total_cli / 50).tolist()
         
         fig = go.Figure(data=go.Scatter(
             x=consumos,
@@ -591,7 +852,8 @@ def gerar_grafico_criticidade_vs_consumo() -> Dict[str, Any]:
 
 
 
-FUNCOES_DISPONIVEIS = {
+# Tabela de despacho das tools do chat (somente leitura)
+FUNCOES_DISPONIVEIS = MappingProxyType({
     "obter_ranking_subestacoes": obter_ranking_subestacoes,
     "obter_subestacoes_em_risco": obter_subestacoes_em_risco,
     "obter_estatisticas_gerais": obter_estatisticas_gerais,
@@ -608,10 +870,13 @@ FUNCOES_DISPONIVEIS = {
     "gerar_grafico_ranking_subestacoes": gerar_grafico_ranking_subestacoes,
     "gerar_grafico_distribuicao_gd": gerar_grafico_distribuicao_gd,
     "gerar_grafico_criticidade_vs_consumo": gerar_grafico_criticidade_vs_consumo
-}
+})
 
 
 if __name__ == "__main__":
+    # Execução direta: o pacote src/ precisa estar no path para "import database"
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    
     # Testes
     print("🧪 Testando funções de consulta ao banco...\n")
     
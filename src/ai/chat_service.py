@@ -1,35 +1,128 @@
 import os
 import sys
 import json
-import traceback
+import asyncio
+import atexit
+import logging
+import logging.handlers
+import queue
+import random
+import re
 import hashlib
-from typing import List, Dict, Any, Optional
+import importlib.util
+import string
+import unicodedata
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple, Literal
+from typing_extensions import TypedDict
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from datetime import datetime, timedelta
 
+import httpx
+try:
+    import orjson
+    _json_dumps, _json_loads = orjson.dumps, orjson.loads
+except ImportError:
+    _json_dumps, _json_loads = json.dumps, json.loads
+try:
+    from xxhash import xxh3_128_hexdigest as _hash_chave
+except ImportError:
+    def _hash_chave(dados: bytes) -> str:
+        return hashlib.blake2b(dados, digest_size=16).hexdigest()
 from google import genai
 from google.genai import types
 from google.genai.errors import ServerError
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-import uvicorn
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+from tenacity import retry, stop_after_attempt, wait_random_exponential, retry_if_exception_type
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from config import CHAT_API_KEY, CHAT_MODEL, CIDADE_ALVO, DISTRIBUIDORA_ALVO
+from config import CHAT_API_KEY, CHAT_MODEL, CHAT_DEBUG, CIDADE_ALVO, DISTRIBUIDORA_ALVO
 from ai.chat_queries import FUNCOES_DISPONIVEIS
 from database import (criar_tabela_feedback, salvar_feedback_chat,
-                    criar_tabelas_historico, criar_conversa, salvar_mensagem, 
+                    criar_tabelas_historico, criar_conversa, salvar_mensagens_batch, 
                     carregar_conversas, carregar_mensagens)
+from cache_redis import redis_client_async
+
+# Cliente único por processo (cada worker do uvicorn cria o seu): o pool do httpx mantém
+# conexões TLS abertas com o Gemini entre requisições e turnos de tools.
+# Criado só no primeiro uso, para o import do módulo não pagar a inicialização
+_client: Optional[genai.Client] = None
+_client_lock = threading.Lock()
+# HTTP/2 multiplexa as chamadas concorrentes numa só conexão; o httpx só o aceita com o pacote h2 instalado
+_HTTP2 = importlib.util.find_spec("h2") is not None
+
+
+def get_client() -> genai.Client:
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = genai.Client(
+                    api_key=CHAT_API_KEY,
+                    http_options=types.HttpOptions(
+                        async_client_args={
+                            "http2": _HTTP2,
+                            "limits": httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=60.0)
+                        }
+                    )
+                )
+    return _client
 
-client = genai.Client(api_key=CHAT_API_KEY)
 try:
     criar_tabela_feedback()
     criar_tabelas_historico()
 except Exception as e:
     print(f"⚠️ Erro ao inicializar: {e}")
 
-app = FastAPI(title="GridScope Chat IA", version="1.0")
+# Tools sem argumento que o modelo mais chama: pré-calculadas no startup (ficam memoizadas por versão do cache_mercado)
+_TOOLS_AQUECIMENTO = (
+    "obter_estatisticas_gerais",
+    "obter_ranking_subestacoes",
+    "obter_distribuicao_consumo_por_classe",
+    "obter_insights_inteligentes",
+    "obter_metricas_performance",
+)
+
+
+def _aquecer_tools() -> None:
+    for nome in _TOOLS_AQUECIMENTO:
+        try:
+            FUNCOES_DISPONIVEIS[nome]()
+        except Exception as e:
+            print(f"⚠️ Aquecimento de {nome} falhou: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Carrega o cache de mercado e memoiza as tools agregadas antes da primeira pergunta,
+    # para o primeiro usuário não pagar a leitura do banco no meio do function calling
+    await asyncio.to_thread(_aquecer_tools)
+    yield
+
+
+app = FastAPI(title="GridScope Chat IA", version="1.0", lifespan=lifespan,
+              default_response_class=ORJSONResponse)
+
+# Diagnóstico detalhado vai para debug: com o nível padrão (INFO) a formatação nem acontece.
+# O caminho da requisição só enfileira o registro; a escrita em stdout fica na thread do QueueListener
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(
+    _log_queue, logging.StreamHandler(sys.stdout), respect_handler_level=True
+)
+_log_listener.handlers[0].setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+_log = logging.getLogger(__name__)
+_log.setLevel(logging.INFO)
+_log.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log.propagate = False
 
 CONTEXTO_SISTEMA = f"""
 Você é um assistente especializado em análise de redes elétricas de distribuição.
@@ -69,18 +162,108 @@ DIRETRIZES PARA GRÁFICOS (MUITO IMPORTANTE):
    - Criticidade vs Consumo -> `gerar_grafico_criticidade_vs_consumo`
 """
 
+class GeminiIndisponivel(Exception):
+    """Disjuntor aberto: o Gemini falhou seguidamente e a chamada nem é feita."""
+
+
+# Disjuntor: após _DISJUNTOR_FALHAS erros 5xx seguidos (já contando os retries), novas chamadas
+# falham na hora por _DISJUNTOR_RESET_S segundos em vez de esperar o backoff contra um servidor sobrecarregado
+_DISJUNTOR_FALHAS = 5
+_DISJUNTOR_RESET_S = 30.0
+_disjuntor = {"falhas": 0, "aberto_ate": 0.0}
+_disjuntor_lock = threading.Lock()
+
+
+def _disjuntor_aberto() -> bool:
+    with _disjuntor_lock:
+        return time.monotonic() < _disjuntor["aberto_ate"]
+
+
+def _verificar_disjuntor() -> None:
+    if _disjuntor_aberto():
+        raise GeminiIndisponivel("Gemini indisponível (UNAVAILABLE): disjuntor aberto")
+
+
+def _registrar_resultado_gemini(sucesso: bool) -> None:
+    with _disjuntor_lock:
+        if sucesso:
+            _disjuntor["falhas"] = 0
+            return
+        _disjuntor["falhas"] += 1
+        if _disjuntor["falhas"] >= _DISJUNTOR_FALHAS:
+            _disjuntor["aberto_ate"] = time.monotonic() + _DISJUNTOR_RESET_S
+            _disjuntor["falhas"] = 0
+
+
+# Backoff exponencial com jitter só para 5xx; 429 (cota diária) não adianta repetir.
+# reraise=True devolve o ServerError original em vez de RetryError
+_TENTATIVAS_GEMINI = 3
+
+
 @retry(
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(multiplier=1, min=2, max=10),
-    retry=retry_if_exception_type(ServerError)
+    stop=stop_after_attempt(_TENTATIVAS_GEMINI),
+    wait=wait_random_exponential(multiplier=1, min=2, max=10),
+    retry=retry_if_exception_type(ServerError),
+    reraise=True
 )
-def call_gemini_with_retry(client, model, contents, config):
-    return client.models.generate_content(
+async def _gerar_conteudo(client, model, contents, config):
+    # API assíncrona do SDK: o event loop atende outras conversas enquanto o Gemini responde
+    return await client.aio.models.generate_content(
         model=model,
         contents=contents,
         config=config
     )
 
+
+async def call_gemini_with_retry(client, model, contents, config):
+    _verificar_disjuntor()
+    try:
+        resposta = await _gerar_conteudo(client, model, contents, config)
+    except ServerError:
+        _registrar_resultado_gemini(False)
+        raise
+    _registrar_resultado_gemini(True)
+    return resposta
+
+
+async def _transmitir_rodada(model, contents, config, partes_modelo: List[Any], chamadas: List[Any]):
+    """
+    Uma rodada do /chat/stream: repassa cada trecho de texto assim que chega e
+    acumula as partes e function_calls nas listas recebidas. Passa pelo mesmo
+    disjuntor do call_gemini_with_retry; ServerError só é repetido (com backoff)
+    enquanto nenhum trecho saiu, porque depois o cliente já recebeu texto.
+    """
+    for tentativa in range(1, _TENTATIVAS_GEMINI + 1):
+        _verificar_disjuntor()
+        partes_modelo.clear()
+        chamadas.clear()
+        emitiu = False
+        try:
+            # A requisição só sai na primeira iteração: erros aparecem dentro do async for
+            stream = await get_client().aio.models.generate_content_stream(
+                model=model,
+                contents=contents,
+                config=config
+            )
+            async for chunk in stream:
+                candidato = chunk.candidates[0] if chunk.candidates else None
+                for part in (candidato.content.parts if candidato and candidato.content else None) or ():
+                    partes_modelo.append(part)
+                    if part.function_call:
+                        chamadas.append(part.function_call)
+                    elif part.text and not part.thought:
+                        emitiu = True
+                        yield part.text
+        except ServerError:
+            if emitiu or tentativa == _TENTATIVAS_GEMINI:
+                _registrar_resultado_gemini(False)
+                raise
+            # Mesmo intervalo do wait_random_exponential(min=2, max=10) do tenacity
+            await asyncio.sleep(random.uniform(2, min(10, 2 ** tentativa)))
+            continue
+        _registrar_resultado_gemini(True)
+        return
+
 tools = [
     types.Tool(
         function_declarations=[
@@ -263,17 +446,358 @@ tools = [
     )
 ]
 
+# Configurações de geração montadas uma vez (o SDK não altera o objeto recebido).
+# O contexto vai como system_instruction, fora de contents: não é reenviado como mensagem do usuário
+_CFG_INICIAL = types.GenerateContentConfig(
+    system_instruction=CONTEXTO_SISTEMA,
+    tools=tools,
+    temperature=0.7
+)
+_CFG_FERRAMENTAS = types.GenerateContentConfig(
+    system_instruction=CONTEXTO_SISTEMA,
+    tools=tools,
+    max_output_tokens=2500,  # Aumentado para 2500 para evitar cortar respostas
+    temperature=0.75
+)
+_CFG_TEXTO = types.GenerateContentConfig(
+    system_instruction=CONTEXTO_SISTEMA,
+    max_output_tokens=2800,
+    temperature=0.68
+)
+
+# Contents já montados por conversa (LRU em memória): conversa_id -> (tamanho, impressão do histórico, contents)
+_SESSOES: "OrderedDict[int, Tuple[int, str, List[types.Content]]]" = OrderedDict()
+_MAX_SESSOES = 256
+_sessoes_lock = threading.Lock()
+
+
+# Papel do histórico (frontend/banco) -> papel do Gemini
+_PAPEL_GEMINI = {"user": "user", "assistant": "model"}
+
+
+def _impressao_historico(historico: List[Dict[str, str]]) -> str:
+    """Hash (xxh3) dos pares role/content: mesmo tamanho não garante o mesmo histórico."""
+    return _hash_chave("\x1e".join(f"{msg['role']}\x1f{msg['content']}" for msg in historico).encode())
+
+
+def _contents_do_historico(conversa_id: Optional[int], historico: List[Dict[str, str]]) -> List[types.Content]:
+    """
+    Histórico como lista de Content. Se a conversa está em memória e o
+    histórico recebido tem o mesmo tamanho e a mesma impressão do guardado,
+    reaproveita os objetos (cópia rasa da lista); senão, remonta a partir das
+    mensagens (outra aba, histórico recarregado do banco, cliente que o refez).
+    """
+    if conversa_id:
+        with _sessoes_lock:
+            sessao = _SESSOES.get(conversa_id)
+        # Hash fora do lock; a posição no LRU é renovada por _guardar_sessao ao fim de cada turno
+        if (sessao is not None and sessao[0] == len(historico)
+                and sessao[1] == _impressao_historico(historico)):
+            return list(sessao[2])
+    
+    return [
+        types.Content(role=_PAPEL_GEMINI[msg["role"]], parts=[types.Part(text=msg["content"])])
+        for msg in historico
+    ]
+
+
+def _guardar_sessao(conversa_id: Optional[int], contents: List[types.Content],
+                    historico: List[Dict[str, str]]) -> None:
+    if not conversa_id:
+        return
+    impressao = _impressao_historico(historico)
+    with _sessoes_lock:
+        _SESSOES[conversa_id] = (len(historico), impressao, contents)
+        _SESSOES.move_to_end(conversa_id)
+        while len(_SESSOES) > _MAX_SESSOES:
+            _SESSOES.popitem(last=False)
+
+
+# Janela deslizante do histórico: só os últimos turnos vão literais ao Gemini, o resto vira um resumo.
+# O resumo substitui o prefixo em historico_atualizado, então o próximo pedido já chega compactado.
+# Ao estourar a janela, só _TURNOS_APOS_RESUMO turnos ficam literais: os turnos seguintes cabem sem
+# novo resumo e o histórico que chega é o mesmo guardado na sessão (reaproveita os Contents)
+_MAX_TURNOS_HISTORICO = 6
+_TURNOS_APOS_RESUMO = 3
+_PREFIXO_RESUMO = "[Resumo da conversa anterior]: "
+_MODELO_RESUMO = "gemini-2.5-flash-lite"
+_CFG_RESUMO = types.GenerateContentConfig(
+    system_instruction="Resuma a conversa a seguir em Português, em até 10 linhas, preservando nomes de subestações, números e conclusões.",
+    max_output_tokens=600,
+    temperature=0.2
+)
+_RESUMOS: "OrderedDict[str, str]" = OrderedDict()
+_MAX_RESUMOS = 256
+
+
+async def _comprimir_historico(historico: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """
+    Se o histórico passa de _MAX_TURNOS_HISTORICO turnos (pergunta + resposta),
+    troca tudo menos os últimos _TURNOS_APOS_RESUMO turnos por uma única mensagem de resumo.
+    Resumos ficam em memória pelo hash do prefixo; se o resumo falhar, devolve o histórico intacto.
+    """
+    limite = 2 * _MAX_TURNOS_HISTORICO
+    if len(historico) <= limite:
+        return historico
+    # Com o disjuntor aberto o resumo também falharia: segue com o histórico inteiro
+    if _disjuntor_aberto():
+        return historico
+    
+    manter = 2 * _TURNOS_APOS_RESUMO
+    prefixo, recentes = historico[:-manter], historico[-manter:]
+    texto = "\n".join(f"{msg.get('role')}: {msg.get('content', '')}" for msg in prefixo)
+    chave = _hash_chave(texto.encode())
+    
+    with _sessoes_lock:
+        resumo = _RESUMOS.get(chave)
+    if resumo is None:
+        try:
+            resposta = await get_client().aio.models.generate_content(
+                model=_MODELO_RESUMO,
+                contents=texto,
+                config=_CFG_RESUMO
+            )
+            resumo = (resposta.text or "").strip()
+        except Exception as e:
+            _log.warning("⚠️ Erro ao resumir histórico: %s", e)
+            return historico
+        if not resumo:
+            return historico
+        with _sessoes_lock:
+            _RESUMOS[chave] = resumo
+            while len(_RESUMOS) > _MAX_RESUMOS:
+                _RESUMOS.popitem(last=False)
+    
+    return [{"role": "user", "content": _PREFIXO_RESUMO + resumo}] + recentes
+
+
+# Cache de respostas no Redis para perguntas que abrem conversa (sem histórico):
+# a mesma pergunta não gasta cota do Gemini nem refaz as consultas enquanto a entrada viver
+CACHE_TTL_SECONDS = 3600
+
+
+_SEM_PONTUACAO = str.maketrans("", "", string.punctuation + "¿¡“”‘’«»…")
+
+
+def _normalizar_mensagem(mensagem: str) -> str:
+    """
+    Forma canônica da pergunta para a chave do cache: sem caixa, acentos,
+    pontuação e espaços repetidos ("Qual o ranking?" == "qual  o ranking").
+    """
+    texto = unicodedata.normalize("NFKD", mensagem.casefold())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    return " ".join(texto.translate(_SEM_PONTUACAO).split())
+
+
+# Chave não precisa de hash criptográfico: xxh3 (ou blake2b sem xxhash) custa uma fração do md5.
+# Mensagens repetidas (leitura e gravação do mesmo turno) nem recalculam o hash
+@lru_cache(maxsize=4096)
+def get_cache_key(mensagem: str) -> str:
+    return f"chat_response:{_hash_chave(_normalizar_mensagem(mensagem).encode())}"
+
+
+# Sem PING prévio: Redis fora do ar vira exceção e a pergunta segue para o Gemini
+async def get_cached_response(mensagem: str) -> Optional[Dict[str, Any]]:
+    if redis_client_async is None:
+        return None
+    try:
+        cached = await redis_client_async.get(get_cache_key(mensagem))
+        return _json_loads(cached) if cached else None
+    except Exception as e:
+        _log.warning("⚠️ Erro ao ler cache do chat: %s", e)
+        return None
+
+
+async def save_to_cache(mensagem: str, resposta: str, graficos: Optional[List[Dict[str, Any]]]) -> None:
+    if redis_client_async is None:
+        return
+    try:
+        data = {"resposta": resposta, "graficos": graficos}
+        # orjson devolve bytes, que o Redis grava sem outro encode
+        await redis_client_async.setex(get_cache_key(mensagem), CACHE_TTL_SECONDS, _json_dumps(data))
+    except Exception as e:
+        _log.warning("⚠️ Erro ao salvar cache do chat: %s", e)
+
+
+def _executar_ferramenta(function_name: str, function_args: Dict[str, Any]) -> Any:
+    _log.debug("🔧 Chamando função: %s com args: %s", function_name, function_args)
+    
+    funcao = FUNCOES_DISPONIVEIS.get(function_name)
+    if funcao is None:
+        return {"erro": f"Função {function_name} não encontrada"}
+    try:
+        resultado = funcao(**function_args)
+        _log.info("✅ Função %s executada com sucesso", function_name)
+    except Exception as e:
+        _log.error("❌ Erro ao executar função %s: %s", function_name, e)
+        resultado = {"erro": str(e)}
+    return resultado
+
+
+async def _executar_chamadas(chamadas: List[Any], graficos_gerados: List[Dict[str, Any]]) -> Tuple[List[str], types.Content]:
+    """
+    Executa as function_calls de um turno ao mesmo tempo e devolve os nomes e o
+    Content "function" com uma resposta por chamada, na ordem dos pedidos.
+    Gráficos válidos são acrescentados em graficos_gerados.
+    """
+    nomes_chamadas = [fc.name for fc in chamadas]
+    argumentos = [fc.args or {} for fc in chamadas]
+    # Tools consultam cache/banco (bloqueante): cada uma numa thread, todas ao mesmo tempo.
+    # gather devolve na ordem das chamadas: respostas casam com os pedidos do modelo
+    resultados = await asyncio.gather(
+        *(asyncio.to_thread(_executar_ferramenta, nome, args)
+          for nome, args in zip(nomes_chamadas, argumentos)),
+        return_exceptions=True
+    )
+    resultados = [
+        {"erro": str(r)} if isinstance(r, Exception) else r
+        for r in resultados
+    ]
+    
+    for function_name, resultado in zip(nomes_chamadas, resultados):
+        # Nome desconhecido já volta como {"erro"} de _executar_ferramenta: não precisa consultar o dicionário de novo
+        if function_name.startswith("gerar_grafico_"):
+            if isinstance(resultado, dict) and "spec" in resultado and "tipo" in resultado:
+                graficos_gerados.append(resultado)
+                _log.info("📊 Gráfico capturado: %s", resultado.get('titulo', 'Sem título'))
+            else:
+                _log.warning("⚠️ A função %s não retornou um gráfico válido:Keys=%s", function_name,
+                             resultado.keys() if isinstance(resultado, dict) else 'Not Dict')
+    
+    return nomes_chamadas, types.Content(
+        role="function",
+        parts=[
+            types.Part(
+                function_response=types.FunctionResponse(
+                    name=nome,
+                    response={"result": resultado}
+                )
+            )
+            for nome, resultado in zip(nomes_chamadas, resultados)
+        ]
+    )
+
+
+def _mensagem_erro_gemini(e: Exception, function_name: Optional[str] = None) -> Optional[str]:
+    """
+    Texto para o usuário quando a chamada ao Gemini falha por cota (429) ou
+    indisponibilidade (5xx, sobrecarga ou disjuntor aberto); None para os demais erros.
+    function_name indica que as tools já rodaram antes da falha.
+    """
+    erro = str(e)
+    if "429" in erro or "RESOURCE_EXHAUSTED" in erro:
+        if function_name:
+            return "⏰ **Cota da API Gemini excedida durante processamento!**\n\nO sistema conseguiu consultar os dados, mas a cota acabou ao formatar a resposta.\n\n**Soluções:**\n1. Aguardar até amanhã (~3h AM)\n2. Criar nova API key em outro projeto\n\nDados consultados: função `" + function_name + "` executada com sucesso."
+        return "⏰ **Cota da API Gemini excedida!**\n\nO plano gratuito do modelo `gemini-3-flash-preview` permite apenas **20 requisições por dia**.\n\n**Soluções:**\n1. Aguardar até amanhã (~3h AM) para renovação da cota\n2. Criar nova API key em outro projeto do Google Cloud\n3. Fazer upgrade para plano pago\n\n[Gerenciar API Keys](https://aistudio.google.com/app/apikey)"
+    if isinstance(e, (GeminiIndisponivel, ServerError)) or "UNAVAILABLE" in erro or "overloaded" in erro.lower():
+        if function_name:
+            return "🔄 **Servidor Gemini temporariamente indisponível**\n\nO servidor do Google Gemini está sobrecarregado neste momento.\n\n✅ **Seus dados foram consultados com sucesso:**\n- Função `" + function_name + "` executada\n\n💡 **Tente novamente em alguns segundos!**"
+        return "🔄 **Servidor Gemini temporariamente indisponível**\n\nO servidor do Google Gemini está sobrecarregado neste momento.\n\n💡 **Tente novamente em alguns segundos!**"
+    return None
+
+
+# Rodadas de tools por turno: cada rodada gasta uma requisição da cota diária do Gemini
+MAX_TOOL_TURNS = 5
+_MSG_LIMITE_FERRAMENTAS = "⚠️ A pergunta exigiu consultas demais em sequência. Os dados foram consultados no banco, mas tente reformular a pergunta de forma mais específica."
+
+
+# Compiladas uma vez; só rodam quando o texto contém mesmo um spec Plotly
+_RE_SPEC_PLOTLY = re.compile(r'\{.*?"tipo":\s*"plotly".*?\}', re.DOTALL)
+_RE_LINHAS_VAZIAS = re.compile(r'\n\s*\n')
+
+
+def _limpar_resposta(resposta_final: str) -> str:
+    """Remove specs Plotly que o modelo às vezes repete no texto (o gráfico já vai em 'graficos')."""
+    if "{" in resposta_final and '"tipo": "plotly"' in resposta_final:
+        resposta_final = _RE_SPEC_PLOTLY.sub('', resposta_final)
+        resposta_final = _RE_LINHAS_VAZIAS.sub('\n\n', resposta_final).strip()
+    return resposta_final
+
+
+async def _iniciar_turno(request: "ChatRequest") -> Optional[int]:
+    """Cria a conversa (se preciso) e devolve o conversa_id; a pergunta é gravada junto com a resposta."""
+    conversa_id = request.conversa_id
+    if not conversa_id and request.usuario_id:
+        titulo = request.mensagem[:50] + "..." if len(request.mensagem) > 50 else request.mensagem
+        conversa_id = await asyncio.to_thread(criar_conversa, request.usuario_id, titulo)
+        _log.info("📝 Nova conversa criada: ID %s", conversa_id)
+    return conversa_id
+
+
+async def _salvar_turno(conversa_id: Optional[int], mensagem: str, resposta: Optional[str]) -> None:
+    """
+    Grava pergunta e resposta numa só transação. Sem resposta (turno que falhou
+    ou voltou cedo), grava só a pergunta, para o histórico no banco não perdê-la.
+    """
+    if not conversa_id:
+        return
+    mensagens = [("user", mensagem)]
+    if resposta is not None:
+        mensagens.append(("assistant", resposta))
+    await asyncio.to_thread(salvar_mensagens_batch, conversa_id, mensagens)
+    _log.info("💾 %d mensagem(ns) salva(s) na conversa %s", len(mensagens), conversa_id)
+
+
+async def _concluir_turno(request: "ChatRequest", conversa_id: Optional[int],
+                          contents_base: List[types.Content], content_usuario: types.Content,
+                          historico_atual: List[Dict[str, str]], resposta_final: str,
+                          graficos_gerados: List[Dict[str, Any]], cacheavel: bool) -> None:
+    """Guarda a sessão em memória, o cache da resposta e a pergunta + resposta no banco."""
+    historico_atual.append({"role": "assistant", "content": resposta_final})
+    
+    # Próximo turno desta conversa parte destes objetos (só texto, como na remontagem)
+    _guardar_sessao(
+        conversa_id,
+        contents_base + [content_usuario, types.Content(role="model", parts=[types.Part(text=resposta_final)])],
+        historico_atual
+    )
+
+    if cacheavel:
+        await save_to_cache(request.mensagem, resposta_final, graficos_gerados or None)
+    
+    await _salvar_turno(conversa_id, request.mensagem, resposta_final)
+
+
+class TurnoHistorico(TypedDict):
+    """Mensagem do histórico; TypedDict para o Pydantic validar no core e entregar dicts simples."""
+    role: Literal["user", "assistant"]
+    content: str
+
+
 class ChatRequest(BaseModel):
     mensagem: str
-    historico: List[Dict[str, str]] = []
+    historico: List[TurnoHistorico] = []
     conversa_id: Optional[int] = None
     usuario_id: Optional[str] = None
+    # True: historico_atualizado traz só as mensagens deste turno e o cliente as acrescenta ao seu histórico
+    # (exceto quando historico_completo vem True: aí ele substitui o histórico inteiro)
+    retornar_delta: bool = False
 
-class ChatResponse(BaseModel):
-    resposta: str
-    historico_atualizado: List[Dict[str, str]]
-    conversa_id: Optional[int] = None
-    graficos: Optional[List[Dict[str, Any]]] = None
+
+def _historico_da_resposta(request: ChatRequest, historico_atual: List[Dict[str, str]],
+                           tamanho_base: int, comprimido: bool = False) -> Dict[str, Any]:
+    """
+    Campos historico_atualizado/historico_completo da resposta: o histórico inteiro, ou só o que
+    entrou depois das tamanho_base primeiras mensagens se o cliente pediu delta.
+    Se o histórico foi resumido, vai inteiro mesmo em delta: o cliente troca o seu pelo compactado
+    e o próximo pedido chega com o mesmo prefixo (resumo e sessão reaproveitados).
+    """
+    completo = not request.retornar_delta or comprimido
+    return {
+        "historico_atualizado": historico_atual if completo else historico_atual[tamanho_base:],
+        "historico_completo": completo
+    }
+
+def _resposta_chat(resposta: str, historico: Dict[str, Any],
+                  conversa_id: Optional[int] = None,
+                  graficos: Optional[List[Dict[str, Any]]] = None) -> ORJSONResponse:
+    """Resposta do /chat/message serializada direto pelo orjson (sem passar por um modelo Pydantic)."""
+    return ORJSONResponse({
+        "resposta": resposta,
+        **historico,
+        "conversa_id": conversa_id,
+        "graficos": graficos
+    })
 
 class FeedbackRequest(BaseModel):
     pergunta: str
@@ -281,213 +805,284 @@ class FeedbackRequest(BaseModel):
     feedback: bool
     comentario: str = None
 
-@app.post("/chat/message", response_model=ChatResponse)
-def enviar_mensagem(request: ChatRequest):
+@app.post("/chat/message", response_class=ORJSONResponse, response_model=None)
+async def enviar_mensagem(request: ChatRequest):
+    conversa_id = None
+    turno_salvo = False
     try:
-        conversa_id = request.conversa_id
-        if not conversa_id and request.usuario_id:
-            titulo = request.mensagem[:50] + "..." if len(request.mensagem) > 50 else request.mensagem
-            conversa_id = criar_conversa(request.usuario_id, titulo)
-            print(f"📝 Nova conversa criada: ID {conversa_id}")
-        if conversa_id:
-            salvar_mensagem(conversa_id, "user", request.mensagem)
-            print(f"💾 Mensagem do usuário salva na conversa {conversa_id}")
-        
-        contents = [types.Content(role="user", parts=[types.Part(text=CONTEXTO_SISTEMA)])]
+        conversa_id = await _iniciar_turno(request)
         
-        for msg in request.historico:
-            role = "user" if msg["role"] == "user" else "model"
-            contents.append(types.Content(role=role, parts=[types.Part(text=msg["content"])]))
+        # Só perguntas sem histórico são cacheáveis: com contexto, a mesma frase pode pedir outra coisa
+        cacheavel = not request.historico
+        if cacheavel:
+            em_cache = await get_cached_response(request.mensagem)
+            if em_cache:
+                _log.info("⚡ Resposta do chat servida do cache")
+                resposta_final = em_cache["resposta"]
+                historico_atual = [
+                    {"role": "user", "content": request.mensagem},
+                    {"role": "assistant", "content": resposta_final}
+                ]
+                await _salvar_turno(conversa_id, request.mensagem, resposta_final)
+                turno_salvo = True
+                return _resposta_chat(
+                    resposta=resposta_final,
+                    historico=_historico_da_resposta(request, historico_atual, 0),
+                    conversa_id=conversa_id,
+                    graficos=em_cache.get("graficos")
+                )
         
-        contents.append(types.Content(role="user", parts=[types.Part(text=request.mensagem)]))
+        historico = await _comprimir_historico(request.historico)
+        comprimido = historico is not request.historico
+        contents_base = _contents_do_historico(conversa_id, historico)
+        content_usuario = types.Content(role="user", parts=[types.Part(text=request.mensagem)])
+        contents = contents_base + [content_usuario]
         
         try:
-            response = call_gemini_with_retry(
-                client,
+            response = await call_gemini_with_retry(
+                get_client(),
                 'gemini-3-flash-preview',
                 contents,
-                types.GenerateContentConfig(
-                    tools=tools,
-                    temperature=0.7
-                )
+                _CFG_INICIAL
             )
         except Exception as e:
-            if "429" in str(e) or "RESOURCE_EXHAUSTED" in str(e):
-                return ChatResponse(
-                    resposta="⏰ **Cota da API Gemini excedida!**\n\nO plano gratuito do modelo `gemini-3-flash-preview` permite apenas **20 requisições por dia**.\n\n**Soluções:**\n1. Aguardar até amanhã (~3h AM) para renovação da cota\n2. Criar nova API key em outro projeto do Google Cloud\n3. Fazer upgrade para plano pago\n\n[Gerenciar API Keys](https://aistudio.google.com/app/apikey)",
-                    historico_atualizado=request.historico,
+            mensagem_erro = _mensagem_erro_gemini(e)
+            if mensagem_erro:
+                return _resposta_chat(
+                    resposta=mensagem_erro,
+                    historico=_historico_da_resposta(request, request.historico, len(request.historico)),
                     conversa_id=conversa_id
                 )
             raise
         
-        historico_atual = request.historico.copy()
+        historico_atual = historico.copy()
         historico_atual.append({"role": "user", "content": request.mensagem})
         
-        generation_config = types.GenerateContentConfig(
-            max_output_tokens=2800,
-            temperature=0.68
-        )
-        
-        max_iterations = 10
-        iteration = 0
         graficos_gerados = []  # Lista para coletar gráficos
+        limite_ferramentas = False
         
-        while iteration < max_iterations:
-            iteration += 1
-            
+        for iteration in range(1, MAX_TOOL_TURNS + 2):
             try:
-                has_function_call = (
-                    response.candidates and 
-                    len(response.candidates) > 0 and
-                    response.candidates[0].content.parts and
-                    len(response.candidates[0].content.parts) > 0 and
-                    hasattr(response.candidates[0].content.parts[0], 'function_call') and
-                    response.candidates[0].content.parts[0].function_call
-                )
-                if not has_function_call:
-                    print(f"✅ Fim do function calling (iteração {iteration})")
+                partes = (response.candidates[0].content.parts or []) if response.candidates else []
+                chamadas = [p.function_call for p in partes if getattr(p, 'function_call', None)]
+                if not chamadas:
+                    _log.info("✅ Fim do function calling (iteração %d)", iteration)
                     break
             except Exception as e:
-                print(f"⚠️ Erro ao verificar function_call: {e}")
+                _log.warning("⚠️ Erro ao verificar function_call: %s", e)
                 break
             
-            function_call = response.candidates[0].content.parts[0].function_call
-            function_name = function_call.name
-            function_args = dict(function_call.args)
+            if iteration > MAX_TOOL_TURNS:
+                _log.warning("⚠️ Limite de %d rodadas de function calling atingido", MAX_TOOL_TURNS)
+                limite_ferramentas = True
+                break
             
-            print(f"🔧 Chamando função: {function_name} com args: {function_args}")
-            
-            if function_name in FUNCOES_DISPONIVEIS:
-                try:
-                    resultado = FUNCOES_DISPONIVEIS[function_name](**function_args)
-                    print(f"✅ Função {function_name} executada com sucesso")
-                except Exception as e:
-                    print(f"❌ Erro ao executar função {function_name}: {e}")
-                    resultado = {"erro": str(e)}
-                
-                if function_name.startswith("gerar_grafico_"):
-                    if isinstance(resultado, dict) and "spec" in resultado and "tipo" in resultado:
-                        graficos_gerados.append(resultado)
-                        print(f"📊 Gráfico capturado: {resultado.get('titulo', 'Sem título')}")
-                    else:
-                        print(f"⚠️ A função {function_name} não retornou um gráfico válido:Keys={resultado.keys() if isinstance(resultado, dict) else 'Not Dict'}")
-
-            else:
-                resultado = {"erro": f"Função {function_name} não encontrada"}
+            nomes_chamadas, content_respostas = await _executar_chamadas(chamadas, graficos_gerados)
+            function_name = ", ".join(nomes_chamadas)
             
             contents.append(response.candidates[0].content)
-            
-            contents.append(types.Content(
-                role="function",
-                parts=[types.Part(
-                    function_response=types.FunctionResponse(
-                        name=function_name,
-                        response={"result": resultado}
-                    )
-                )]
-            ))
+            contents.append(content_respostas)
             
             try:
-                response = call_gemini_with_retry(
-                    client,
+                response = await call_gemini_with_retry(
+                    get_client(),
                     'gemini-3-flash-preview',
                     contents,
-                    types.GenerateContentConfig(
-                        tools=tools,
-                        max_output_tokens=2500,  # Aumentado para 2500 para evitar cortar respostas
-                        temperature=0.75
-                    )
+                    _CFG_FERRAMENTAS
                 )
             except Exception as e:
-                error_str = str(e)
-                if "429" in error_str or "RESOURCE_EXHAUSTED" in error_str:
-                    return ChatResponse(
-                        resposta="⏰ **Cota da API Gemini excedida durante processamento!**\n\nO sistema conseguiu consultar os dados, mas a cota acabou ao formatar a resposta.\n\n**Soluções:**\n1. Aguardar até amanhã (~3h AM)\n2. Criar nova API key em outro projeto\n\nDados consultados: função `" + function_name + "` executada com sucesso.",
-                        historico_atualizado=historico_atual
-                    )
-                elif "503" in error_str or "UNAVAILABLE" in error_str or "overloaded" in error_str.lower():
-                    return ChatResponse(
-                        resposta="🔄 **Servidor Gemini temporariamente indisponível**\n\nO servidor do Google Gemini está sobrecarregado neste momento.\n\n✅ **Seus dados foram consultados com sucesso:**\n- Função `" + function_name + "` executada\n\n💡 **Tente novamente em alguns segundos!**",
-                        historico_atualizado=historico_atual
+                mensagem_erro = _mensagem_erro_gemini(e, function_name)
+                if mensagem_erro:
+                    return _resposta_chat(
+                        resposta=mensagem_erro,
+                        historico=_historico_da_resposta(request, historico_atual, len(historico), comprimido)
                     )
                 raise
         
         
         
         
-        resposta_final = ""
-        if hasattr(response, 'candidates') and response.candidates:
-            print(f"DEBUG: Candidates count: {len(response.candidates)}")
-            if len(response.candidates) > 0:
-                first_candidate = response.candidates[0]
-                if hasattr(first_candidate, 'content') and first_candidate.content:
-                    print(f"DEBUG: Content parts count: {len(first_candidate.content.parts)}")
-                    if hasattr(first_candidate.content, 'parts') and first_candidate.content.parts:
-                        for part in first_candidate.content.parts:
-                            print(f"DEBUG: Part text: {getattr(part, 'text', 'N/A')}")
-                            if hasattr(part, 'text') and part.text:
-                                resposta_final = part.text
-                                break
-        
-        if not resposta_final or resposta_final.strip() == "":
+        if limite_ferramentas:
+            resposta_final = _MSG_LIMITE_FERRAMENTAS
+            cacheavel = False
+        else:
+            # response.text já concatena as partes de texto do primeiro candidato
             try:
-                if hasattr(response, 'text') and response.text:
-                    resposta_final = response.text
-                    print(f"✅ Extraído de response.text: '{resposta_final[:100]}'")
+                resposta_final = (getattr(response, 'text', None) or "").strip()
             except Exception as ex:
-                print(f"⚠️ response.text não disponível: {ex}")
+                _log.warning("⚠️ response.text não disponível: %s", ex)
+                resposta_final = ""
         
-        if not resposta_final or resposta_final.strip() == "":
-            print("⚠️ Resposta vazia detectada. Forçando uma última chamada para gerar texto...")
+        if not resposta_final:
+            candidatos = getattr(response, 'candidates', None)
+            content = getattr(candidatos[0], 'content', None) if candidatos else None
+            partes = getattr(content, 'parts', None) or ()
+            if _log.isEnabledFor(logging.DEBUG):
+                _log.debug("Candidates: %d, parts: %d", len(candidatos or ()), len(partes))
+            resposta_final = "".join(p.text for p in partes if getattr(p, 'text', None)).strip()
+        
+        if not resposta_final:
+            _log.warning("⚠️ Resposta vazia detectada. Forçando uma última chamada para gerar texto...")
             try:
-                retry_contents = [types.Content(role="user", parts=[types.Part(text=CONTEXTO_SISTEMA)])]
-                
-                for msg in historico_atual:
-                    role = "user" if msg.get("role") == "user" else "model"
-                    content_text = msg.get("content", "")
-                    if content_text:
-                        retry_contents.append(types.Content(role=role, parts=[types.Part(text=str(content_text))]))
+                retry_contents = [
+                    types.Content(role=_PAPEL_GEMINI[msg["role"]], parts=[types.Part(text=msg["content"])])
+                    for msg in historico_atual if msg["content"]
+                ]
                 
                 # Adiciona o prompt de força
                 retry_contents.append(types.Content(role="user", parts=[types.Part(text="Com base nos dados acima, responda minha pergunta original de forma direta e em Português.")]))
 
-                final_response = client.models.generate_content(
-                    model=CHAT_MODEL,
-                    contents=retry_contents,
-                    config=generation_config
+                final_response = await call_gemini_with_retry(
+                    get_client(),
+                    CHAT_MODEL,
+                    retry_contents,
+                    _CFG_TEXTO
                 )
                 
                 if hasattr(final_response, 'text') and final_response.text:
                     resposta_final = final_response.text
-                    print(f"✅ Texto recuperado com chamada extra: '{resposta_final[:100]}'")
+                    _log.info("✅ Texto recuperado com chamada extra: '%.100s'", resposta_final)
             except Exception as retry_ex:
-                print(f"❌ Falha no retry de resposta vazia: {retry_ex}")
+                _log.error("❌ Falha no retry de resposta vazia: %s", retry_ex)
 
         if not resposta_final or resposta_final.strip() == "":
             resposta_final = "⚠️ O modelo processou a requisição mas não retornou texto. Os dados foram consultados com sucesso no banco."
+            cacheavel = False
         
-        if "{" in resposta_final and '"tipo": "plotly"' in resposta_final:
-            import re
-            padrao = r'\{.*?"tipo":\s*"plotly".*?\}'
-            resposta_final = re.sub(padrao, '', resposta_final, flags=re.DOTALL)
-            resposta_final = re.sub(r'\n\s*\n', '\n\n', resposta_final).strip()
-
-        historico_atual.append({"role": "assistant", "content": resposta_final})
-
-        if conversa_id:
-            salvar_mensagem(conversa_id, "assistant", resposta_final)
-            print(f"💾 Resposta do assistente salva na conversa {conversa_id}")
+        resposta_final = _limpar_resposta(resposta_final)
+        await _concluir_turno(request, conversa_id, contents_base, content_usuario,
+                              historico_atual, resposta_final, graficos_gerados, cacheavel)
+        turno_salvo = True
         
-        return ChatResponse(
+        return _resposta_chat(
             resposta=resposta_final,
-            historico_atualizado=historico_atual,
+            historico=_historico_da_resposta(request, historico_atual, len(historico), comprimido),
             conversa_id=conversa_id,
             graficos=graficos_gerados if graficos_gerados else None
         )
         
     except Exception as e:
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"Erro no chat: {str(e)}")
+        _log.exception("❌ Erro no chat")
+        # Detalhes internos (e o traceback, que já foi pro log) só saem para o cliente em modo debug
+        raise HTTPException(status_code=500, detail=f"Erro no chat: {str(e)}" if CHAT_DEBUG else "Erro interno no chat")
+    finally:
+        # Retornos antecipados (cota, indisponibilidade) e erros ainda registram a pergunta
+        if not turno_salvo:
+            await _salvar_turno(conversa_id, request.mensagem, None)
+
+
+def _evento_sse(dados: Dict[str, Any]) -> bytes:
+    # orjson já entrega bytes UTF-8, que o StreamingResponse envia sem reencodar
+    corpo = _json_dumps(dados)
+    return b"data: " + (corpo if isinstance(corpo, bytes) else corpo.encode()) + b"\n\n"
+
+
+@app.post("/chat/stream")
+async def enviar_mensagem_stream(request: ChatRequest):
+    """
+    Mesmo fluxo do /chat/message em Server-Sent Events: cada trecho de texto do
+    Gemini sai como {"delta": ...} assim que chega (tools são executadas entre os
+    trechos) e o último evento traz {"fim": true, "resposta", "historico_atualizado", "historico_completo",
+    "conversa_id", "graficos"}. Falhas viram um evento {"erro": ...}.
+    """
+    conversa_id = await _iniciar_turno(request)
+    cacheavel = not request.historico
+    em_cache = await get_cached_response(request.mensagem) if cacheavel else None
+    
+    async def eventos():
+        turno_salvo = False
+        try:
+            historico_atual = request.historico.copy()
+            historico_atual.append({"role": "user", "content": request.mensagem})
+        
+            if em_cache:
+                resposta_final = em_cache["resposta"]
+                historico_atual.append({"role": "assistant", "content": resposta_final})
+                await _salvar_turno(conversa_id, request.mensagem, resposta_final)
+                turno_salvo = True
+                yield _evento_sse({"delta": resposta_final})
+                yield _evento_sse({"fim": True, "resposta": resposta_final,
+                                   **_historico_da_resposta(request, historico_atual, 0),
+                                   "conversa_id": conversa_id, "graficos": em_cache.get("graficos")})
+                return
+        
+            historico = await _comprimir_historico(request.historico)
+            comprimido = historico is not request.historico
+            if comprimido:
+                historico_atual = historico + [{"role": "user", "content": request.mensagem}]
+            contents_base = _contents_do_historico(conversa_id, historico)
+            content_usuario = types.Content(role="user", parts=[types.Part(text=request.mensagem)])
+            contents = contents_base + [content_usuario]
+            graficos_gerados = []
+            trechos = []
+            config = _CFG_INICIAL
+            function_name = None
+        
+            try:
+                limite_ferramentas = False
+                for rodada in range(MAX_TOOL_TURNS + 1):
+                    partes_modelo = []
+                    chamadas = []
+                    async for texto in _transmitir_rodada('gemini-3-flash-preview', contents, config,
+                                                          partes_modelo, chamadas):
+                        trechos.append(texto)
+                        yield _evento_sse({"delta": texto})
+                
+                    if not chamadas:
+                        break
+                    if rodada == MAX_TOOL_TURNS:
+                        limite_ferramentas = True
+                        break
+                
+                    # function_call só vem completa no fim do stream: executa e volta a transmitir
+                    nomes_chamadas, content_respostas = await _executar_chamadas(chamadas, graficos_gerados)
+                    function_name = ", ".join(nomes_chamadas)
+                    contents.append(types.Content(role="model", parts=partes_modelo))
+                    contents.append(content_respostas)
+                    config = _CFG_FERRAMENTAS
+            
+                cacheavel_turno = cacheavel
+                if limite_ferramentas:
+                    _log.warning("⚠️ Limite de %d rodadas de function calling atingido (stream)", MAX_TOOL_TURNS)
+                    trechos.append(_MSG_LIMITE_FERRAMENTAS)
+                    cacheavel_turno = False
+                    yield _evento_sse({"delta": _MSG_LIMITE_FERRAMENTAS})
+            
+                resposta_final = "".join(trechos)
+                if not resposta_final.strip():
+                    resposta_final = "⚠️ O modelo processou a requisição mas não retornou texto. Os dados foram consultados com sucesso no banco."
+                    cacheavel_turno = False
+                    yield _evento_sse({"delta": resposta_final})
+            
+                resposta_final = _limpar_resposta(resposta_final)
+                await _concluir_turno(request, conversa_id, contents_base, content_usuario,
+                                      historico_atual, resposta_final, graficos_gerados, cacheavel_turno)
+                turno_salvo = True
+            except Exception as e:
+                # Cota e indisponibilidade recebem as mesmas mensagens do /chat/message
+                mensagem_erro = _mensagem_erro_gemini(e, function_name)
+                if mensagem_erro:
+                    _log.warning("⚠️ Gemini falhou no stream: %s", e)
+                    yield _evento_sse({"erro": mensagem_erro})
+                else:
+                    _log.exception("❌ Erro no chat (stream)")
+                    yield _evento_sse({"erro": f"Erro no chat: {str(e)}" if CHAT_DEBUG else "Erro interno no chat"})
+                return
+        
+            yield _evento_sse({"fim": True, "resposta": resposta_final,
+                               **_historico_da_resposta(request, historico_atual, len(historico), comprimido),
+                               "conversa_id": conversa_id, "graficos": graficos_gerados or None})
+        finally:
+            # Erro ou cliente que desconectou no meio do stream: a pergunta ainda vai para o banco
+            if not turno_salvo:
+                await _salvar_turno(conversa_id, request.mensagem, None)
+    
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 
 @app.post("/chat/feedback")
 def enviar_feedback(request: FeedbackRequest):
@@ -543,4 +1138,10 @@ if __name__ == "__main__":
     print(f"🔑 API Key configurada: {'Sim' if CHAT_API_KEY else 'NÃO'}")
     print("\n💡 Acesse a documentação em: http://localhost:8002/docs\n")
     
-    uvicorn.run(app, host="0.0.0.0", port=8002)
+    import uvicorn
+    
+    # Vários workers exigem a app como import string; cada worker tem seu próprio client e LRU de sessões.
+    # loop/http em "auto" usam uvloop e httptools quando instalados (não há uvloop no Windows)
+    import platform
+    workers = 1 if platform.system() == "Windows" else max(2, os.cpu_count() or 1)
+    uvicorn.run("chat_service:app", host="0.0.0.0", port=8002, workers=workers, loop="auto", http="auto")
@@ -123,8 +123,10 @@ def treinar_modelo_universal():
     print(f"📊 Dataset gerado com {len(df)} amostras.")
     print("🚀 Iniciando treinamento do Modelo Universal...")
     
-    X = df.drop(columns=["fator_consumo"])
-    y = df["fator_consumo"]
+    # Treina sobre ndarray: a inferência (ai_service) monta uma matriz NumPy
+    # nesta mesma ordem de colunas, sem passar por DataFrame
+    X = df.drop(columns=["fator_consumo"]).to_numpy(dtype=np.float64)
+    y = df["fator_consumo"].to_numpy()
     
     model = RandomForestRegressor(
         n_estimators=100,
@@ -1,5 +1,6 @@
 
 import redis
+from redis import asyncio as aioredis
 import json
 import logging
 from functools import wraps
@@ -30,6 +31,19 @@ except Exception as e:
     logger.warning(f"⚠️ Redis não configurado corretamente: {e}")
     redis_client = None
 
+# Cliente assíncrono para serviços async (chat): as conexões são abertas sob demanda no event loop
+try:
+    redis_client_async = aioredis.Redis(
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        db=REDIS_DB,
+        decode_responses=True,
+        socket_connect_timeout=2
+    )
+except Exception as e:
+    logger.warning(f"⚠️ Redis assíncrono não configurado corretamente: {e}")
+    redis_client_async = None
+
 def is_redis_available():
     if not redis_client: return False
     try:
@@ -22,3 +22,5 @@ DISTRIBUIDORA_ALVO = os.getenv("DISTRIBUIDORA_ALVO", "Energisa SE")
 # Chat IA
 CHAT_API_KEY = os.getenv("GEMINI_API_KEY")
 CHAT_MODEL = os.getenv("CHAT_MODEL", "gemini-3-flash-preview")
+# Com CHAT_DEBUG ligado, erros do chat devolvem a mensagem da exceção ao cliente
+CHAT_DEBUG = os.getenv("CHAT_DEBUG", "false").lower() in ("1", "true", "sim")
@@ -4,11 +4,12 @@ Centraliza todas as operações com o banco de dados PostgreSQL/PostGIS
 """
 import os
 import sys
+import atexit
 import logging
 import geopandas as gpd
 import pandas as pd
 from sqlalchemy import create_engine, text
-from typing import Optional, List
+from typing import Optional, List, Tuple
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from config import DATABASE_URL
@@ -17,18 +18,29 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("Database")
 
 
+_engine = None
+
+
 def get_engine():
     """
-    Retorna engine SQLAlchemy configurada para PostgreSQL/PostGIS
+    Retorna a engine SQLAlchemy (PostgreSQL/PostGIS) compartilhada pelo processo.
+    Criada e testada na primeira chamada; depois o pool de conexões é reaproveitado
+    (as funções abaixo não chamam dispose(), que fecharia o pool a cada consulta).
     
     Returns:
         Engine: SQLAlchemy engine configurado
     """
+    global _engine
+    if _engine is not None:
+        return _engine
     try:
-        engine = create_engine(DATABASE_URL)
+        # pool_pre_ping: descarta conexões que o servidor fechou enquanto ociosas no pool
+        engine = create_engine(DATABASE_URL, pool_pre_ping=True)
         with engine.connect() as conn:
             conn.execute(text("SELECT 1"))
         logger.info("✅ Conexão com banco de dados estabelecida")
+        _engine = engine
+        atexit.register(engine.dispose)
         return engine
     except Exception as e:
         logger.error(f"❌ Erro ao conectar no banco de dados: {e}")
@@ -62,8 +74,6 @@ def carregar_subestacoes(colunas: Optional[List[str]] = None) -> gpd.GeoDataFram
     except Exception as e:
         logger.error(f"❌ Erro ao carregar subestações: {e}")
         raise
-    finally:
-        engine.dispose()
 
 
 def carregar_transformadores(colunas: Optional[List[str]] = None) -> gpd.GeoDataFrame:
@@ -95,8 +105,6 @@ def carregar_transformadores(colunas: Optional[List[str]] = None) -> gpd.GeoData
     except Exception as e:
         logger.error(f"❌ Erro ao carregar transformadores: {e}")
         raise
-    finally:
-        engine.dispose()
 
 
 def carregar_consumidores(colunas: Optional[List[str]] = None, ignore_geometry: bool = False) -> pd.DataFrame:
@@ -128,8 +136,6 @@ def carregar_consumidores(colunas: Optional[List[str]] = None, ignore_geometry:
     except Exception as e:
         logger.error(f"❌ Erro ao carregar consumidores: {e}")
         raise
-    finally:
-        engine.dispose()
 
 
 def carregar_geracao_gd(colunas: Optional[List[str]] = None, ignore_geometry: bool = False) -> pd.DataFrame:
@@ -161,8 +167,6 @@ def carregar_geracao_gd(colunas: Optional[List[str]] = None, ignore_geometry: bo
     except Exception as e:
         logger.error(f"❌ Erro ao carregar geração distribuída: {e}")
         raise
-    finally:
-        engine.dispose()
 
 
 def carregar_rede_mt(colunas: Optional[List[str]] = None) -> gpd.GeoDataFrame:
@@ -190,8 +194,6 @@ def carregar_rede_mt(colunas: Optional[List[str]] = None) -> gpd.GeoDataFrame:
     except Exception as e:
         logger.error(f"❌ Erro ao carregar rede MT: {e}")
         raise
-    finally:
-        engine.dispose()
 
 
 def carregar_voronoi() -> gpd.GeoDataFrame:
@@ -211,8 +213,6 @@ def carregar_voronoi() -> gpd.GeoDataFrame:
     except Exception as e:
         logger.error(f"❌ Erro ao carregar Voronoi: {e}")
         raise
-    finally:
-        engine.dispose()
 
 
 def salvar_voronoi(gdf: gpd.GeoDataFrame) -> None:
@@ -238,8 +238,6 @@ def salvar_voronoi(gdf: gpd.GeoDataFrame) -> None:
     except Exception as e:
         logger.error(f"❌ Erro ao salvar Voronoi: {e}")
         raise
-    finally:
-        engine.dispose()
 
 
 def criar_tabela_cache():
@@ -263,8 +261,6 @@ def criar_tabela_cache():
     except Exception as e:
         logger.error(f"❌ Erro ao criar tabela cache: {e}")
         raise
-    finally:
-        engine.dispose()
 
 
 def salvar_cache_mercado(dados_mercado: list) -> None:
@@ -305,8 +301,6 @@ def salvar_cache_mercado(dados_mercado: list) -> None:
     except Exception as e:
         logger.error(f"❌ Erro ao salvar cache: {e}")
         raise
-    finally:
-        engine.dispose()
 
 
 def carregar_cache_mercado() -> list:
@@ -342,8 +336,28 @@ def carregar_cache_mercado() -> list:
     except Exception as e:
         logger.error(f"❌ Erro ao carregar cache: {e}")
         raise
-    finally:
-        engine.dispose()
+
+
+def obter_versao_cache_mercado() -> tuple:
+    """
+    Retorna um token barato que muda sempre que o cache_mercado é regravado
+    
+    Returns:
+        Tupla (última data_atualizacao, total de registros)
+    """
+    engine = get_engine()
+    
+    try:
+        with engine.connect() as conn:
+            row = conn.execute(text("""
+                SELECT MAX(data_atualizacao), COUNT(*)
+                FROM cache_mercado
+            """)).fetchone()
+            return (row[0], row[1]) if row else (None, 0)
+            
+    except Exception as e:
+        logger.error(f"❌ Erro ao verificar versão do cache: {e}")
+        raise
 
 
 def verificar_cache_atualizado(max_horas: int = 24) -> bool:
@@ -387,8 +401,6 @@ def verificar_cache_atualizado(max_horas: int = 24) -> bool:
     except Exception as e:
         logger.warning(f"⚠️ Erro ao verificar cache: {e}")
         return False
-    finally:
-        engine.dispose()
 
 
 
@@ -431,8 +443,6 @@ def verificar_tabelas() -> dict:
     except Exception as e:
         logger.error(f"❌ Erro ao verificar tabelas: {e}")
         raise
-    finally:
-        engine.dispose()
 
 
 if __name__ == "__main__":
@@ -594,6 +604,36 @@ def salvar_mensagem(conversa_id: int, role: str, content: str):
         logger.warning(f"⚠️ Erro ao salvar mensagem: {e}")
 
 
+def salvar_mensagens_batch(conversa_id: int, mensagens: List[Tuple[str, str]]):
+    """
+    Grava várias mensagens (role, content) de uma conversa numa única transação:
+    um executemany para os INSERTs e um só UPDATE de updated_at.
+    Como NOW() é o início da transação, as linhas saem com o mesmo created_at;
+    carregar_mensagens desempata pelo id (SERIAL, segue a ordem de inserção).
+    """
+    if not mensagens:
+        return
+    try:
+        engine = get_engine()
+        with engine.begin() as conn:
+            conn.execute(text("""
+                INSERT INTO chat_mensagens (conversa_id, role, content)
+                VALUES (:conversa_id, :role, :content)
+            """), [
+                {"conversa_id": conversa_id, "role": role, "content": content}
+                for role, content in mensagens
+            ])
+            
+            conn.execute(text("""
+                UPDATE chat_conversas 
+                SET updated_at = NOW() 
+                WHERE id = :conversa_id
+            """), {"conversa_id": conversa_id})
+            
+    except Exception as e:
+        logger.warning(f"⚠️ Erro ao salvar mensagens: {e}")
+
+
 def carregar_conversas(usuario_id: str, limite: int = 50):
     """Carrega lista de conversas do usuário"""
     try:
@@ -635,7 +675,7 @@ def carregar_mensagens(conversa_id: int):
                 SELECT role, content, created_at
                 FROM chat_mensagens
                 WHERE conversa_id = :conversa_id
-                ORDER BY created_at ASC
+                ORDER BY created_at ASC, id ASC
             """), {"conversa_id": conversa_id})
             
             mensagens = []
@@ -7,8 +7,6 @@ import sys
 import gc
 from shapely.geometry import mapping
 
-warnings.filterwarnings('ignore')
-
 # garante que os módulos do projeto sejam encontrados
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from database import (
@@ -58,6 +56,13 @@ def calcular_consumo_real(df):
     return df
 
 def analisar_mercado():
+    # silencia warnings só durante a análise; o run_all importa este módulo
+    # no processo supervisor e um filtro global afetaria as demais etapas
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return _analisar_mercado()
+
+def _analisar_mercado():
     print("INICIANDO ANALISE DETALHADA E LIMPEZA DE DADOS...")
     
     dir_script = os.path.dirname(os.path.abspath(__file__))
@@ -180,6 +180,8 @@ def main():
         
         path_img = os.path.join(DIR_RAIZ, NOME_IMAGEM_SAIDA)
         plt.savefig(path_img, dpi=150, bbox_inches='tight', pad_inches=0.1)
+        # libera a figura: no run_all este módulo roda dentro do processo supervisor
+        plt.close(fig)
         print(f"Imagem Salva: {path_img}")
         
     except Exception as e: